@@ -8,9 +8,13 @@
 #
 # Usage:  cat test.txt | python alignify_cli.py
 # Or:     python alignify_cli.py test.txt
+# Or:     python alignify_cli.py --check test.txt  (exits with 1 if test.txt is not aligned)
+# Or:     git diff | python alignify_cli.py --diff -  (aligns only what the diff touched)
 #
 # Or import and use as a python module
 #
+# Or use in Vim with alignify.vim (see README.md)
+#
 # Or use in Sublime Text 3:
 # { "keys": ["super+shift+a"], "command": "alignify" }
 #
@@ -109,19 +113,63 @@ rgb = [
 
 '''
 
+g_validation = 'none'
+'''
+How much of the internal invariants (like "this is a list of nodes") to check while aligning:
+	'full':    everything, every time. test.py uses this.
+	'sampled': every VALIDATION_SAMPLE_EVERY:th check of each kind.
+	'none':    nothing. The checks are swapped out for a function that does nothing.
+Change it at runtime with set_validation.
+'''
+
 # -----------------------------------------------------------
 # Actual code time!
 
+import bisect
+import collections
+import contextlib
 import copy
+import heapq
+import itertools
 import re
+import threading
+import time
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None # No memory reports before Python 3.4
 
 
 # any number followed by whatever (e.g. a comma):
 # Special care is taken to handle thousand delimiters a la Rust: 1_000_000
-RE_NUMBER        = re.compile(r'^[+-]?\.?[\d_]+.*$')
-RE_SIGN_OR_DIGIT = re.compile(r'^[\d_+-]$')
-RE_DIGIT         = re.compile(r'\d_')
-RE_CHARACTER     = re.compile(r'[a-zA-Z_]')
+RE_NUMBER          = re.compile(r'^[+-]?\.?[\d_]+.*$')
+RE_SIGNS_OR_DIGITS = re.compile(r'[\d_+-]*')
+RE_DIGIT           = re.compile(r'\d_')
+RE_CHARACTER       = re.compile(r'[a-zA-Z_]')
+
+
+class CharClasses(dict):
+	'''
+	str.translate table from a character to its class, as used by the levenshtein costs:
+		'A': upper case character (RE_CHARACTER)
+		'a': lower case character or underscore (RE_CHARACTER)
+		'.': anything else
+	Note that RE_DIGIT only matches a digit followed by an underscore, so no single character is a digit
+	as far as the costs are concerned - digits are classed (and costed) as symbols.
+	'''
+	def __missing__(self, code_point):
+		return '.'
+
+CHAR_CLASSES = CharClasses((ord(c), 'A' if c.isupper() else 'a') for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_')
+
+SUBSTITUTION_COST = {
+	'A': {'A':  1, 'a':  2, '.': 10},
+	'a': {'A':  2, 'a':  1, '.': 10},
+	'.': {'A': 10, 'a': 10, '.':  3},
+}
+
+ADD_DEL_COST = {'A': 1, 'a': 1, '.': 10}
 
 
 # For debugging
@@ -131,87 +179,728 @@ def spam(*stuff):
 
 
 # -----------------------------------------------------------
-# Type checks for debugging/readability:
+# Type checks for debugging/readability.
+# The assert_is_* names are rebound by set_validation, so always call them through the module.
 
 
-def assert_is_list_of_strings(x):
-	assert isinstance(x, list) and all((isinstance(elem, str) for elem in x)), \
-		"Expected List[str], got '{}'".format(x)
+def check_list_of_strings(x):
+	if not (isinstance(x, list) and all((isinstance(elem, str) for elem in x))):
+		raise AssertionError("Expected List[str], got '{}'".format(x))
 
 
-def assert_is_node(x):
-	if not isinstance(x, str):
-		assert isinstance(
-			x, list), "Expected Node (str or list), got {}: {}".format(type(x), x)
-		for elem in x:
-			assert id(elem) != id(x), "Self-containing list: {}".format(x)
-			assert_is_node(elem)
+def check_node(x):
+	lists = [x]
+	while lists:
+		x = lists.pop()
+		if not isinstance(x, str):
+			if not isinstance(x, list):
+				raise AssertionError("Expected Node (str or list), got {}: {}".format(type(x), x))
+			for elem in x:
+				if id(elem) == id(x):
+					raise AssertionError("Self-containing list: {}".format(x))
+				lists.append(elem)
 
 
-def assert_is_list_of_nodes(x):
-	assert isinstance(
-		x, list), "Expected List[Node], got {}: {}".format(type(x), x)
+def check_list_of_nodes(x):
+	if not isinstance(x, list):
+		raise AssertionError("Expected List[Node], got {}: {}".format(type(x), x))
 	for elem in x:
-		assert_is_node(elem)
+		check_node(elem)
+
+
+def check_sparse_lines_of_strings(lines):
+	for line in lines:
+		if not (isinstance(line, dict) and all(isinstance(token, str) for token in line.values())):
+			raise AssertionError("Expected {{column: str}}, got '{}'".format(line))
+
+
+def check_list_of_summaries(summaries):
+	''' Each summary is (text, rest_length, rest_children), with a str text (see NodeSummaries) '''
+	if not (isinstance(summaries, list) and all(isinstance(summary, tuple) and isinstance(summary[0], str) for summary in summaries)):
+		raise AssertionError("Expected List[(str, int, int)], got '{}'".format(summaries))
+
+
+VALIDATION_SAMPLE_EVERY = 64
+
+
+def sampled(check):
+	''' check, but only every VALIDATION_SAMPLE_EVERY:th call '''
+	calls = itertools.count()
+	def sampled_check(x):
+		if next(calls) % VALIDATION_SAMPLE_EVERY == 0:
+			check(x)
+	return sampled_check
+
+
+def no_check(x):
+	pass
+
+
+def set_validation(level):
+	''' Sets how much to check while aligning: 'full', 'sampled' or 'none' (see g_validation) '''
+	global g_validation
+	global assert_is_list_of_strings, assert_is_node, assert_is_list_of_nodes, assert_is_sparse_lines_of_strings, assert_is_list_of_summaries
+
+	checks = (check_list_of_strings, check_node, check_list_of_nodes, check_sparse_lines_of_strings, check_list_of_summaries)
+	if level == 'full':
+		pass
+	elif level == 'sampled':
+		checks = tuple(sampled(check) for check in checks)
+	elif level == 'none':
+		checks = (no_check,) * len(checks)
+	else:
+		raise ValueError("Unknown validation level: {!r}".format(level))
+
+	g_validation = level
+	assert_is_list_of_strings, assert_is_node, assert_is_list_of_nodes, assert_is_sparse_lines_of_strings, assert_is_list_of_summaries = checks
+
+
+set_validation(g_validation)
 
 
 # -----------------------------------------------------------
 
 
-def alignify_string(s):
-	return alignify_lines(s.split('\n'))
+Options = collections.namedtuple('Options', [
+	'ignore_empty_lines',            # See g_ignore_empty_lines
+	'continuous',                    # See g_continuous
+	'suffer_whitespace_indentation', # See g_suffer_whitespace_indentation
+	'phantom_tokens',                # Insert phantom tokens into short lines? See expand_short_lines
+	'max_memory',                    # Bytes a block may need before it is aligned more cheaply (or None). See align_block
+	'max_seconds',                   # Time a block may spend on phantom tokens before it is aligned without them (or None). See align_within_deadline
+	'segment',                       # Split blocks where consecutive lines have nothing to align? See segment_block
+])
+'''
+Settings for one call to alignify.
+Immutable and passed along to every stage, so calls with different settings can run concurrently.
+'''
+
+
+def default_options(**overrides):
+	''' Options from the global settings, with any given fields replaced. '''
+	options = Options(
+		ignore_empty_lines            = g_ignore_empty_lines,
+		continuous                    = g_continuous,
+		suffer_whitespace_indentation = g_suffer_whitespace_indentation,
+		phantom_tokens                = True,
+		max_memory                    = None,
+		max_seconds                   = None,
+		segment                       = False,
+	)
+	return options._replace(**overrides)
+
+
+class Report(object):
+	'''
+	Pass one to alignify to find out how it went:
+		degraded:    [(line_nr, reason)] for the blocks that were not fully aligned
+		phase_peaks: {phase: peak bytes allocated during it}. Only filled in while tracemalloc is tracing.
+	'''
+
+	def __init__(self):
+		self.degraded    = []
+		self.phase_peaks = {}
+		self._open_peaks = [] # (start, peak) of phases we are in
+
+	def note_degraded(self, line_nr, reason):
+		self.degraded.append((line_nr, reason))
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		''' Measures peak memory use of a phase. Phases may nest. '''
+		if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak') or not tracemalloc.is_tracing():
+			yield
+			return
+
+		current, peak = tracemalloc.get_traced_memory()
+		if self._open_peaks:
+			start, outer_peak = self._open_peaks[-1]
+			self._open_peaks[-1] = (start, max(outer_peak, peak))
+		self._open_peaks.append((current, current))
+		tracemalloc.reset_peak()
+		try:
+			yield
+		finally:
+			start, phase_peak = self._open_peaks.pop()
+			phase_peak = max(phase_peak, tracemalloc.get_traced_memory()[1])
+			tracemalloc.reset_peak()
+			if self._open_peaks:
+				outer_start, outer_peak = self._open_peaks[-1]
+				self._open_peaks[-1] = (outer_start, max(outer_peak, phase_peak))
+			self.phase_peaks[name] = max(self.phase_peaks.get(name, 0), phase_peak - start)
+
+
+class BlockCache(object):
+	'''
+	Remembers how recently aligned blocks came out, so that identical blocks
+	(same indentation, lines and options) are only aligned once.
+	Holds at most max_blocks blocks, evicting the least recently used.
+	Also remembers up to max_similarities token similarities for the phantom token search,
+	since blocks that differ often still compare the same tokens.
+	Can be shared between threads, and between calls to alignify.
+	'''
+
+	def __init__(self, max_blocks = 1024, max_similarities = 65536):
+		self.max_blocks       = max_blocks
+		self.max_similarities = max_similarities
+		self.hits             = 0
+		self.misses           = 0
+		self._blocks          = collections.OrderedDict()
+		self._similarities    = {}
+		self._lock            = threading.Lock()
+
+	def get(self, key):
+		''' The aligned block stored under key, or None '''
+		with self._lock:
+			aligned = self._blocks.get(key)
+			if aligned is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self._blocks.move_to_end(key)
+			return aligned
+
+	def put(self, key, aligned):
+		with self._lock:
+			self._blocks[key] = aligned
+			self._blocks.move_to_end(key)
+			while len(self._blocks) > self.max_blocks:
+				self._blocks.popitem(last = False)
+
+	def token_similarity(self, a, b, min_similarity = None):
+		'''
+		token_similarity(a, b, min_similarity), remembering the exact ones.
+		A remembered similarity is returned even if it is below min_similarity, which is allowed.
+		'''
+		similarity = self._similarities.get((a, b))
+		if similarity is None:
+			similarity = token_similarity(a, b, min_similarity)
+			if min_similarity is None or similarity >= min_similarity:
+				if len(self._similarities) >= self.max_similarities:
+					self._similarities.clear() # Cheaper than keeping track of which ones are used
+				self._similarities[(a, b)] = similarity
+		return similarity
+
+	def __len__(self):
+		return len(self._blocks)
+
+
+@contextlib.contextmanager
+def measure(report, phase):
+	''' report.phase(phase), if there is a report '''
+	if report is None:
+		yield
+	else:
+		with report.phase(phase):
+			yield
 
 
-def alignify_lines(lines):
-	# Split into blocks of same indentation:
+def alignify_string(s, options = None, report = None, cache = None, pool = None):
+	return alignify_lines(s.split('\n'), options, report, cache, pool)
+
+
+def alignify_lines(lines, options = None, report = None, cache = None, pool = None):
+	'''
+	Aligns the lines, returning the aligned text.
+	With a multiprocessing pool, the phantom tokens of big blocks are found in parallel (see expand_short_lines).
+	The output is the same with or without it.
+	'''
+	options = options or default_options()
+	output = ""
+
+	for first_line_nr, left_indentation, ast_lines, meat_lines in split_blocks(lines, options, report = report):
+		aligned = align_block(first_line_nr, left_indentation, ast_lines, meat_lines, options, report, cache, pool)
+		with measure(report, 'output'):
+			output += aligned
+
+	if output.endswith('\n'):
+		output = output[0:-1]
+
+	return output
+
+
+def alignify_many(strings, options = None, jobs = 1, cache = None, batch_size = 64, pool = None):
+	'''
+	alignify_string on each of the strings, returning a list of the results in the same order.
+	If aligning a string fails, its result is the exception instead, and the other strings are still aligned.
+	The strings share one BlockCache (the given one, if any), so repeated blocks and tokens are only compared once.
+	Given a multiprocessing pool, or jobs > 1 for a pool of that many processes made for this call,
+	the strings are instead sent to the processes in batches of batch_size.
+	Each process then keeps a BlockCache of its own for all the batches it gets,
+	so to keep those warm between calls, pass the same pool each time.
+	A cache can't be shared with other processes, so passing one along with a pool or jobs > 1 is a ValueError.
+	'''
+	options = options or default_options()
+	strings = iter(strings)
+
+	if pool is None and jobs <= 1:
+		cache = cache if cache is not None else BlockCache()
+		return alignify_batch((list(strings), options), cache)
+
+	if cache is not None:
+		raise ValueError("alignify_many can't share a cache with other processes")
+
+	batches = iter(lambda: (list(itertools.islice(strings, batch_size)), options), ([], options))
+	if pool is not None:
+		return [result for batch_results in pool.imap(alignify_batch, batches) for result in batch_results]
+
+	import multiprocessing
+	pool = multiprocessing.Pool(jobs)
+	try:
+		return [result for batch_results in pool.imap(alignify_batch, batches) for result in batch_results]
+	finally:
+		pool.terminate()
+
+
+g_batch_cache = None
+''' The BlockCache of alignify_batch in this process, kept between batches '''
+
+
+def alignify_batch(batch, cache = None):
+	''' Worker of alignify_many: aligns each of the strings in batch = (strings, options) '''
+	global g_batch_cache
+	if cache is None:
+		if g_batch_cache is None:
+			g_batch_cache = BlockCache()
+		cache = g_batch_cache
+
+	strings, options = batch
+	results = []
+	for s in strings:
+		try:
+			results.append(alignify_string(s, options, cache = cache))
+		except Exception as e:
+			results.append(e)
+	return results
+
+
+def split_blocks(lines, options, first_line_nr = 0, report = None):
+	'''
+	Splits lines into blocks of same indentation and parses them, one block at a time.
+	Yields (first_line_nr, left_indentation, ast_lines, meat_lines) for each block,
+	where meat_lines is the text each line of ast_lines was parsed from.
+	lines[0] is taken to be line number first_line_nr.
+	'''
+	block_start  = first_line_nr
 	block_indent = []
+	block_text   = []
 	block_meat   = []
 	last_indent  = None
 
-	output = ""
-
 	for ix, line in enumerate(lines):
 		spam("line: '", line, "'")
 
-		if g_ignore_empty_lines and line == '':
+		if options.ignore_empty_lines and line == '':
 			block_indent.append('')
+			block_text.append('')
 			block_meat.append([''])
 			continue
 
-		if g_suffer_whitespace_indentation:
-			# Try matching tabs first - if none, match spaces two and two
-			m      = re.match("(\t+|(  )*)(.*)", line)
-			indent = m.group(1)
-			meat   = m.group(3)
-		else:
-			m      = re.match("(\t*)(.*)", line)
-			indent = m.group(1)
-			meat   = m.group(2)
-
-		# Replace non-leading tabs with spaces. Any number of spaces will work.
-		meat = re.sub(r'\t', '  ', meat)
-		nodes, _ = parse(meat)
+		indent, meat = split_indentation(line, options)
+		with measure(report, 'parse'):
+			nodes, _ = parse(meat)
 		assert_is_list_of_nodes(nodes)
 
 		if last_indent != None and indent != last_indent:
 			# A change in indentation - align what we have so far:
-			spam("alignify_lines: indentation break: '", indent, "'")
-			output += align_and_collect(block_indent, block_meat)
+			spam("split_blocks: indentation break: '", indent, "'")
+			for block in segment_block(block_start, block_indent, block_meat, block_text, options):
+				yield block
+			block_start  = first_line_nr + ix
 			block_indent = []
+			block_text   = []
 			block_meat   = []
 
 		block_indent.append(indent)
+		block_text.append(meat)
 		block_meat.append(nodes)
 		last_indent = indent
 
-	output += align_and_collect(block_indent, block_meat)
+	if block_indent:
+		for block in segment_block(block_start, block_indent, block_meat, block_text, options):
+			yield block
 
-	if output.endswith('\n'):
-		output = output[0:-1]
 
+def segment_block(first_line_nr, left_indentation, ast_lines, meat_lines, options):
+	'''
+	Yields the block from split_blocks as it is, or if options.segment,
+	split into smaller blocks wherever two consecutive lines share no alignable structure (see line_signature).
+	Lines with a single node don't take part, since there is nothing to align them with anyway.
+	'''
+	if not options.segment:
+		yield first_line_nr, left_indentation, ast_lines, meat_lines
+		return
+
+	begin = 0
+	last_signature = None
+	for ix, nodes in enumerate(ast_lines):
+		signature = line_signature(nodes)
+		if signature is None:
+			continue
+		if last_signature is not None and not shares_structure(last_signature, signature):
+			spam("segment_block: break at line ", first_line_nr + ix)
+			yield first_line_nr + begin, left_indentation[begin:ix], ast_lines[begin:ix], meat_lines[begin:ix]
+			begin = ix
+		last_signature = signature
+
+	yield first_line_nr + begin, left_indentation[begin:], ast_lines[begin:], meat_lines[begin:]
+
+
+def line_signature(nodes):
+	'''
+	What a line can be aligned on: (number of non-space nodes, set of anchors), or None for lines with a single node.
+	Anchors are the tokens of only punctuation (like = : , ->), {groups} and comments.
+	'''
+	anchors = set()
+	num_nodes = 0
+	for node in nodes:
+		if not isinstance(node, str):
+			anchors.add('{}')
+		else:
+			token = annotate(node)
+			if token.kind == 'space' or token.kind == 'empty':
+				continue
+			if token.kind == 'comment':
+				anchors.add('//')
+			elif set(token.classes) == set('.') and not any(c.isdigit() for c in token):
+				anchors.add(token)
+		num_nodes += 1
+
+	if num_nodes <= 1:
+		return None
+	return num_nodes, anchors
+
+
+def shares_structure(a, b):
+	''' Could lines with these line_signatures be aligned with each other? '''
+	return a[0] == b[0] or bool(a[1] & b[1])
+
+
+def split_indentation(line, options):
+	''' Returns (indentation, meat) of a line. '''
+	if options.suffer_whitespace_indentation:
+		# Try matching tabs first - if none, match spaces two and two
+		m      = re.match("(\t+|(  )*)(.*)", line)
+		indent = m.group(1)
+		meat   = m.group(3)
+	else:
+		m      = re.match("(\t*)(.*)", line)
+		indent = m.group(1)
+		meat   = m.group(2)
+
+	# Replace non-leading tabs with spaces. Any number of spaces will work.
+	meat = re.sub(r'\t', '  ', meat)
+	return indent, meat
+
+
+def find_block(lines, line_nr, options):
+	'''
+	Returns (begin, end) of the block split_blocks would put lines[line_nr] in.
+	Only looks at the lines of that block (and the ones bordering it).
+	'''
+	def is_skipped(line):
+		return options.ignore_empty_lines and line == ''
+
+	# Skipped empty lines belong to the block above them:
+	anchor = line_nr
+	while anchor >= 0 and is_skipped(lines[anchor]):
+		anchor -= 1
+	if anchor < 0:
+		# ...or to the first block, if they come first:
+		anchor = line_nr
+		while anchor < len(lines) and is_skipped(lines[anchor]):
+			anchor += 1
+		if anchor == len(lines):
+			return 0, len(lines)
+
+	indent = split_indentation(lines[anchor], options)[0]
+
+	begin = anchor
+	ix = anchor - 1
+	while ix >= 0:
+		if not is_skipped(lines[ix]):
+			if split_indentation(lines[ix], options)[0] != indent:
+				break
+			begin = ix
+		ix -= 1
+	if ix < 0:
+		begin = 0
+
+	end = anchor + 1
+	while end < len(lines):
+		if not is_skipped(lines[end]) and split_indentation(lines[end], options)[0] != indent:
+			break
+		end += 1
+
+	return begin, end
+
+
+def touched_blocks(lines, line_nrs, options):
+	''' Sorted (begin, end) of the blocks containing any of the given line numbers. '''
+	blocks = []
+	for line_nr in sorted(set(line_nrs)):
+		if 0 <= line_nr < len(lines) and not (blocks and line_nr < blocks[-1][1]):
+			blocks.append(find_block(lines, line_nr, options))
+	return blocks
+
+
+def align_block_lines(lines, options, first_line_nr = 0, report = None, cache = None):
+	''' Aligns lines that make up a single block (see find_block). Returns a list of lines. '''
+	aligned = []
+	for block in split_blocks(lines, options, first_line_nr, report):
+		aligned += align_block(*block, options = options, report = report, cache = cache).split('\n')[:-1]
+	return aligned
+
+
+def alignify_touched_lines(lines, line_nrs, options = None, report = None, cache = None):
+	'''
+	Like alignify_lines, but only aligns the blocks that contain any of the given (0-based) line numbers.
+	All other lines are left untouched, and are not even parsed.
+	Returns a list of lines.
+	'''
+	options = options or default_options()
+	output = []
+	done = 0
+	for begin, end in touched_blocks(lines, line_nrs, options):
+		output += lines[done:begin]
+		output += align_block_lines(lines[begin:end], options, begin, report, cache)
+		done = end
+	output += lines[done:]
 	return output
 
 
+def line_edits(lines, line_nrs = None, options = None, report = None, cache = None):
+	'''
+	Yields (line_nr, old_line, new_line) for each line alignify_lines would change, block by block as they are aligned.
+	Lines that don't change are never yielded.
+	If line_nrs is given, only the blocks containing those lines are aligned.
+	'''
+	options = options or default_options()
+	if line_nrs is None:
+		blocks = split_blocks(lines, options, report = report)
+	else:
+		blocks = (block for begin, end in touched_blocks(lines, line_nrs, options)
+		                for block in split_blocks(lines[begin:end], options, begin, report))
+
+	for first_line_nr, left_indentation, ast_lines, meat_lines in blocks:
+		aligned = align_block(first_line_nr, left_indentation, ast_lines, meat_lines, options, report, cache).split('\n')
+		for offset in range(len(left_indentation)):
+			line_nr = first_line_nr + offset
+			if aligned[offset] != lines[line_nr]:
+				yield line_nr, lines[line_nr], aligned[offset]
+
+
+def find_unaligned_line(lines, line_nrs = None, options = None, report = None, cache = None):
+	'''
+	Returns the index of the first line alignify_lines would change, or None if there is none.
+	Stops at the first block that isn't aligned, without looking at the rest.
+	If line_nrs is given, only the blocks containing those lines are checked.
+	'''
+	for line_nr, _, _ in line_edits(lines, line_nrs, options, report, cache):
+		return line_nr
+	return None
+
+
+def changed_lines(lines, options = None, report = None, cache = None):
+	'''
+	Returns [(line_nr, aligned_line)] for the lines alignify_lines would change, and nothing for the rest.
+	Meant for editors, that can then replace just these lines.
+	'''
+	return [(line_nr, new_line) for line_nr, _, new_line in line_edits(lines, None, options, report, cache)]
+
+
+def unified_diff(lines, file_name = '-', line_nrs = None, context = 3, options = None, report = None, cache = None):
+	'''
+	Yields the lines of a unified diff (without line endings) from lines to how alignify_lines would align them.
+	Only the changed lines and their context are looked at; the aligned text is never put together.
+	If line_nrs is given, only the blocks containing those lines are aligned.
+	'''
+	hunk = [] # (line_nr, old_line, new_line) of the edits in the current hunk
+
+	def hunk_lines():
+		begin = max(hunk[0][0] - context, 0)
+		end   = min(hunk[-1][0] + context + 1, len(lines))
+		# Alignment never adds or removes lines, so both sides have the same range:
+		yield "@@ -{0},{1} +{0},{1} @@".format(begin + 1, end - begin)
+		# Edits of consecutive lines are shown as all removals followed by all additions:
+		runs = []
+		for edit in hunk:
+			if runs and edit[0] == runs[-1][-1][0] + 1:
+				runs[-1].append(edit)
+			else:
+				runs.append([edit])
+
+		next_line_nr = begin
+		for run in runs:
+			for ix in range(next_line_nr, run[0][0]):
+				yield " " + lines[ix]
+			for _, old_line, _ in run:
+				yield "-" + old_line
+			for _, _, new_line in run:
+				yield "+" + new_line
+			next_line_nr = run[-1][0] + 1
+		for ix in range(next_line_nr, end):
+			yield " " + lines[ix]
+
+	for edit in line_edits(lines, line_nrs, options, report, cache):
+		if not hunk:
+			yield "--- " + file_name
+			yield "+++ " + file_name
+		elif edit[0] - hunk[-1][0] > 2 * context:
+			for line in hunk_lines():
+				yield line
+			hunk = []
+		hunk.append(edit)
+
+	if hunk:
+		for line in hunk_lines():
+			yield line
+
+
+class Document(object):
+	'''
+	Lines to align, for editors that only show some of them at a time.
+	The blocks are found up front, but each is only aligned when one of its lines is first asked for.
+	Blocks near the visible lines (see show) are aligned first by align_next,
+	which an editor can call whenever it is idle, or from a background thread, until it returns False.
+
+		document = Document(lines)
+		document.show(first_visible, last_visible + 1)
+		visible = document.get_lines(first_visible, last_visible + 1)
+		while document.align_next():
+			pass
+
+	The aligned lines are the same as from alignify_lines.
+	'''
+
+	def __init__(self, lines, options = None, report = None, cache = None):
+		self.lines    = lines
+		self.options  = options or default_options()
+		self.report   = report
+		self.cache    = cache
+		self.blocks   = [] # (begin, end) of each block
+		self._begins  = [] # begin of each block, for bisect
+		self._aligned = {} # block index -> aligned lines of the block
+		self._lock    = threading.Lock()
+
+		begin = 0
+		while begin < len(lines):
+			_, end = find_block(lines, begin, self.options)
+			self.blocks.append((begin, end))
+			self._begins.append(begin)
+			begin = end
+
+		self.show(0, 0)
+
+	def show(self, begin, end):
+		''' Lines begin to end are visible: align_next should do the blocks closest to them first '''
+		def distance(block_idx):
+			block_begin, block_end = self.blocks[block_idx]
+			return max(block_begin - end + 1, begin - block_end + 1, 0)
+
+		with self._lock:
+			self._queue = [(distance(block_idx), block_idx) for block_idx in range(len(self.blocks))
+			               if block_idx not in self._aligned]
+			heapq.heapify(self._queue)
+
+	def align_next(self):
+		''' Aligns the next block in line. Returns False once all blocks are aligned. '''
+		while True:
+			with self._lock:
+				if not self._queue:
+					return False
+				_, block_idx = heapq.heappop(self._queue)
+			if block_idx not in self._aligned:
+				self._block_lines(block_idx)
+				return True
+
+	def is_aligned(self):
+		return len(self._aligned) == len(self.blocks)
+
+	def get_line(self, line_nr):
+		''' The aligned line, aligning its block if it hasn't been '''
+		block_idx = bisect.bisect_right(self._begins, line_nr) - 1
+		return self._block_lines(block_idx)[line_nr - self.blocks[block_idx][0]]
+
+	def get_lines(self, begin = 0, end = None):
+		''' The aligned lines begin to end, aligning just the blocks they are in '''
+		end = len(self.lines) if end is None else min(end, len(self.lines))
+		output = []
+		line_nr = begin
+		while line_nr < end:
+			block_idx = bisect.bisect_right(self._begins, line_nr) - 1
+			block_begin, block_end = self.blocks[block_idx]
+			output += self._block_lines(block_idx)[line_nr - block_begin:min(block_end, end) - block_begin]
+			line_nr = block_end
+		return output
+
+	def _block_lines(self, block_idx):
+		aligned = self._aligned.get(block_idx)
+		if aligned is None:
+			begin, end = self.blocks[block_idx]
+			aligned = align_block_lines(self.lines[begin:end], self.options, begin, self.report, self.cache)
+			with self._lock:
+				aligned = self._aligned.setdefault(block_idx, aligned)
+		return aligned
+
+
+def find_decimal_place(token):
+	''' Where to align the token if it is a number, else None. '''
+	if not RE_NUMBER.match(token):
+		return None
+	return RE_SIGNS_OR_DIGITS.match(token).end()
+
+
+class Token(str):
+	'''
+	A string node, annotated by parse with what later stages want to know about it,
+	so that each token is classified once rather than for every comparison:
+		kind:       'empty' (phantom), 'space', 'comment', 'operator' (see is_operator_token) or 'word'
+		classes:    the class of each character (see CharClasses)
+		decimal:    where to align it if it is a number (see find_decimal_place), else None
+		is_comment: is_comment(token)
+	Get them from annotate(), which shares one Token between all tokens with the same text.
+	'''
+
+	def __new__(cls, text):
+		self = str.__new__(cls, text)
+		self.classes    = text.translate(CHAR_CLASSES)
+		self.decimal    = find_decimal_place(text)
+		self.is_comment = is_comment(text)
+
+		if text == '':
+			self.kind = 'empty'
+		elif text == ' ':
+			self.kind = 'space'
+		elif self.is_comment:
+			self.kind = 'comment'
+		elif len(text) == 1 and self.classes == '.':
+			self.kind = 'operator'
+		else:
+			self.kind = 'word'
+
+		return self
+
+
+MAX_INTERNED_TOKENS = 65536
+
+
+g_tokens = {}
+''' The Token of each text annotate has seen, so equal tokens are annotated (and stored) once. Cleared when full. '''
+
+
+def annotate(s):
+	''' s as a Token '''
+	if isinstance(s, Token):
+		return s
+	token = g_tokens.get(s)
+	if token is None:
+		if len(g_tokens) >= MAX_INTERNED_TOKENS:
+			g_tokens.clear()
+		token = g_tokens[s] = Token(s)
+	return token
+
+
 def is_comment(s):
 	if len(s) >= 2 and s[0] == '#' and s[1] == ' ':
 		# # one line Python/bash comment
@@ -230,12 +919,16 @@ def is_comment(s):
 	return False
 
 
+SPACE = Token(' ')
+
+
 def parse(s, i = 0, until = None):
 	'''
-	Recursive decent - breaks at end or reaching when pushing a string node starting with character 'until'.
+	Breaks at end or when pushing a string node starting with character 'until'.
 	Returns an AST. Each node is either a string or a list.
 	Input: a single line
 	A token is a continuing block of code with no unquoted spaces
+	Nested groups are kept on an explicit stack rather than recursed into, so any nesting depth works.
 	'''
 
 	SPACE_BEFORE = ""
@@ -247,71 +940,87 @@ def parse(s, i = 0, until = None):
 		# '<': '>',
 	}
 
-	nodes = []
+	nodes  = []
+	groups = [] # (nodes, until) of the groups enclosing the one we are in
+	start  = None # Start of the current token, if in the middle of one
 	n = len(s)
 
-	while i < n:
-		# Skip spaces:
-		did_skip_spaces = False
-		while i < n and s[i] == ' ':
-			i += 1
-			did_skip_spaces = True
-		if did_skip_spaces:
-			nodes.append(' ')
-
-		start = i
-
-		while i < n and s[i] != ' ':
-			c = s[i]
-
-			if c == "'" or c == '"':
-				i += 1
-				while i < n:
-					if s[i] == '\\':
-						i += 2
-					elif s[i] == c:
-						i += 1
-						break
-					else:
-						i += 1
+	while True:
+		group_done = False
 
-			elif is_comment(s[i:]):
-				i = n
+		while i < n and not group_done:
+			if start is None:
+				# Skip spaces:
+				did_skip_spaces = False
+				while i < n and s[i] == ' ':
+					i += 1
+					did_skip_spaces = True
+				if did_skip_spaces:
+					nodes.append(SPACE)
 
-			elif c in NESTINGS:
-				# eg:  foo{
-				opener = s[start:i+1]
-				nested, i = parse(s, i+1, NESTINGS[c])
-				nested.insert(0, opener)
-				nodes.append(nested)
 				start = i
 
-			elif c in SPACE_BEFORE:
-				if start != i:
-					nodes.append(s[start:i])
+			while i < n and s[i] != ' ':
+				c = s[i]
+
+				if c == "'" or c == '"':
+					i += 1
+					while i < n:
+						if s[i] == '\\':
+							i += 2
+						elif s[i] == c:
+							i += 1
+							break
+						else:
+							i += 1
+
+				elif is_comment(s[i:i+3]): # is_comment only looks at the first few characters
+					i = n
+
+				elif c in NESTINGS:
+					# eg:  foo{
+					groups.append((nodes, until))
+					nodes = [annotate(s[start:i+1])]
+					until = NESTINGS[c]
+					start = None
+					i += 1
+					break
+
+				elif c in SPACE_BEFORE:
+					if start != i:
+						nodes.append(annotate(s[start:i]))
+						if nodes[-1][0] == until:
+							group_done = True
+							break
+					start = i
+					i += 1
+
+				elif c in SPACE_AFTER:
+					nodes.append(annotate(s[start:i+1]))
 					if nodes[-1][0] == until:
-						return nodes, i
-				start = i
-				i += 1
+						group_done = True
+						break
+					i += 1
+					start = i
 
-			elif c in SPACE_AFTER:
-				nodes.append(s[start:i+1])
-				if nodes[-1][0] == until:
-					return nodes, i
-				i += 1
-				start = i
+				else:
+					i += 1
 
 			else:
-				i += 1
-
-		if start != i:
-			nodes.append(s[start:i])
-			if nodes[-1][0] == until:
-				return nodes, i
+				if start != i:
+					nodes.append(annotate(s[start:i]))
+					if nodes[-1][0] == until:
+						group_done = True
+				start = None
 
-	spam("parse: ", s, " -> ", nodes)
+		# The group ended, or we ran out of line:
+		if not groups:
+			return nodes, i
 
-	return nodes, i
+		group = nodes
+		nodes, until = groups.pop()
+		nodes.append(group)
+		start = i # Continue the token the group was opened in
 
 
 def concat_lines(left, right):
@@ -321,18 +1030,132 @@ def concat_lines(left, right):
 	return [l + r for l, r in zip(left, right)]
 
 
-def align_and_collect(left_indentation, ast_lines):
+# Rough sizes (in bytes) for estimate_block_memory, measured with tracemalloc:
+NODE_BYTES     = 64 # A node in the lines of a block once they are padded to the longest, with its copies and summaries
+CHAR_BYTES     = 2  # A character of aligned output, counting the copies made while joining
+DP_CELL_BYTES  = 32 # A cell of the phantom token table (see expand_line_ending)
+
+
+def estimate_block_memory(ast_lines, phantom_tokens):
+	'''
+	Rough estimate of the peak memory (in bytes) align_ast_lines needs for a block.
+	Each line costs its nodes, padded to the longest line, plus the nodes in its {groups} and its output,
+	which is as wide as the columns it reaches.
+	The phantom token table grows with the square of the longest line or {group}.
+	'''
+	num_columns = max(len(line) for line in ast_lines)
+	widths      = [0] * num_columns
+	longest     = num_columns
+	num_nodes   = num_columns * len(ast_lines)
+
+	for line in ast_lines:
+		for column_idx, node in enumerate(line):
+			if isinstance(node, str):
+				widths[column_idx] = max(widths[column_idx], len(node))
+			else:
+				widths[column_idx] = max(widths[column_idx], len(collapse_node(node)))
+				groups = [node]
+				while groups:
+					group = groups.pop()
+					longest = max(longest, len(group))
+					num_nodes += len(group)
+					groups.extend(child for child in group if not isinstance(child, str))
+
+	reach = [0] # reach[n] = width of the first n columns
+	for width in widths:
+		reach.append(reach[-1] + width)
+
+	memory = num_nodes * NODE_BYTES + sum(reach[len(line)] for line in ast_lines) * CHAR_BYTES
+	if phantom_tokens:
+		memory += longest * longest * DP_CELL_BYTES
+	return memory
+
+
+def align_block(first_line_nr, left_indentation, ast_lines, meat_lines, options, report = None, cache = None, pool = None):
+	'''
+	align_and_collect, but degrades rather than running out of memory.
+	A block projected to need more than options.max_memory is aligned without phantom tokens,
+	or if that is still too much, left as it is. So is a block that runs into a MemoryError.
+	Degraded blocks are noted in the report.
+	'''
+	if options.max_memory is not None:
+		if estimate_block_memory(ast_lines, options.phantom_tokens) > options.max_memory:
+			if options.phantom_tokens and estimate_block_memory(ast_lines, False) <= options.max_memory:
+				options = options._replace(phantom_tokens = False)
+				if report is not None:
+					report.note_degraded(first_line_nr, "aligned without phantom tokens to stay within the memory budget")
+			else:
+				if report is not None:
+					report.note_degraded(first_line_nr, "left unaligned to stay within the memory budget")
+				return "\n".join(concat_lines(left_indentation, list(meat_lines))) + "\n"
+
+	try:
+		if options.max_seconds is not None and options.phantom_tokens:
+			return align_within_deadline(first_line_nr, left_indentation, ast_lines, meat_lines, options, report, cache, pool)
+		return align_and_collect(left_indentation, ast_lines, meat_lines, options, report, cache = cache, pool = pool)
+	except MemoryError:
+		if report is not None:
+			report.note_degraded(first_line_nr, "left unaligned after running out of memory")
+		return "\n".join(concat_lines(left_indentation, list(meat_lines))) + "\n"
+
+
+class DeadlineExceeded(Exception):
+	''' Raised by the phantom token search when the deadline given to it has passed. '''
+	pass
+
+
+def align_within_deadline(first_line_nr, left_indentation, ast_lines, meat_lines, options, report = None, cache = None, pool = None):
+	'''
+	Anytime version of align_and_collect: first aligns the block without phantom tokens, which is quick,
+	then tries again with them until options.max_seconds have passed.
+	Returns the best alignment that finished in time. If that is the cheap one, the block is noted in the report.
+	'''
+	deadline = time.monotonic() + options.max_seconds
+	cheap_lines = [list(line_nodes) for line_nodes in ast_lines] # strip_comments changes the lines it is given
+	cheap = align_and_collect(left_indentation, cheap_lines, meat_lines, options._replace(phantom_tokens = False), report, cache = cache)
+
+	try:
+		return align_and_collect(left_indentation, ast_lines, meat_lines, options, report, deadline, cache, pool)
+	except DeadlineExceeded:
+		if report is not None:
+			report.note_degraded(first_line_nr, "aligned without phantom tokens to stay within the time budget")
+		return cheap
+
+
+def align_and_collect(left_indentation, ast_lines, meat_lines = None, options = None, report = None, deadline = None, cache = None, pool = None):
+	'''
+	meat_lines, if given, is the text each line of ast_lines was parsed from.
+	It lets us return blocks that are already aligned without realigning them,
+	and to look the block up in the cache (a BlockCache), if one is given.
+	If the phantom token search is still running at the given deadline (a time.monotonic()), DeadlineExceeded is raised.
+	'''
 	assert len(left_indentation) == len(ast_lines)
 	if len(left_indentation) == 0:
 		return "\n"
 
+	options = options or default_options()
+	key = None
+	if cache is not None and meat_lines is not None:
+		key = (tuple(left_indentation), tuple(meat_lines), options)
+		aligned = cache.get(key)
+		if aligned is not None:
+			return aligned
+
 	assert_is_list_of_strings(left_indentation)
 	assert_is_list_of_nodes(ast_lines[0])
 	comments = strip_comments(ast_lines)
-	lines = align_ast_lines(ast_lines)
-	lines = append_comments(lines, comments)
-	results = concat_lines(left_indentation, lines)
-	return "\n".join(results) + "\n"
+	if meat_lines is not None and is_aligned_block(meat_lines, ast_lines, comments):
+		spam("align_and_collect: already aligned")
+		aligned = "\n".join(concat_lines(left_indentation, list(meat_lines))) + "\n"
+	else:
+		lines = align_ast_lines(ast_lines, options, report, deadline, pool, cache)
+		lines = append_comments(lines, comments)
+		results = concat_lines(left_indentation, lines)
+		aligned = "\n".join(results) + "\n"
+
+	if key is not None:
+		cache.put(key, aligned)
+	return aligned
 
 
 def strip_comments(ast_lines):
@@ -347,7 +1170,7 @@ def strip_comments(ast_lines):
 	for line_nr, right in enumerate(ast_lines):
 		if len(right) >= 2:
 			last = right[-1]
-			if isinstance(last, str) and is_comment(last):
+			if isinstance(last, str) and annotate(last).is_comment:
 				comments[line_nr] = last
 				right.pop()
 
@@ -370,72 +1193,208 @@ def append_comments(lines, comments):
 	return lines
 
 
-def align_ast_lines(ast_lines):
-	assert len(ast_lines) > 0
-	assert_is_list_of_nodes(ast_lines[0])
-	# print("ast_lines: {}".format(ast_lines))
-	ast_lines = expand_short_lines(ast_lines)
-	# print("expanded:  {}".format(ast_lines))
-	ast_lines = unfold_list_nodes(ast_lines)
-	# print("unfolded:  {}".format(ast_lines))
-	assert_is_list_of_strings(ast_lines[0])
-	aligned = align_columns(ast_lines)
-	assert_is_list_of_strings(aligned)
-	# print("aligned:   {}".format(aligned))
-	return aligned
+# -----------------------------------------------------------------------------
+# Fast check for blocks that are already aligned (e.g. when re-alignifying).
+
+
+def is_aligned_block(meat_lines, ast_lines, comments):
+	'''
+	Returns True if aligning ast_lines (with the stripped comments) is known to reproduce
+	meat_lines exactly, so the block can be returned as-is.
+	This is a cheap scan over the token positions, bailing out at the first misplaced token.
+	A False return means "don't know", not "not aligned".
+	'''
+	ends = aligned_ends(meat_lines, [0] * len(meat_lines), ast_lines)
+	if ends is None:
+		return False
+
+	comment_column = 0
+	for line_nr, comment in enumerate(comments):
+		if comment:
+			comment_column = max(comment_column, ends[line_nr])
+
+	for line_nr, text in enumerate(meat_lines):
+		end = ends[line_nr]
+		if comments[line_nr]:
+			if not is_spaces(text, end, comment_column):
+				return False
+			if text[comment_column:] != comments[line_nr]:
+				return False
+		elif end != len(text):
+			return False
 
+	return True
 
-def unfold_list_nodes(in_ast_lines):
-	num_lines = len(in_ast_lines)
-	num_columns = len(in_ast_lines[0])
 
-	out_ast_lines = copy.deepcopy(in_ast_lines)
+MAX_ALIGNED_CHECK_DEPTH = 32
+
+
+def aligned_ends(texts, bases, ast_lines, depth = 0):
+	'''
+	Checks that every token of ast_lines already sits where align_ast_lines would put it,
+	given that line i of the aligned output starts at texts[i][bases[i]:].
+	Returns where the aligned output of each line ends, or None on the first misplaced token.
+	Also returns None if any line needs phantom tokens, since only expand_short_lines
+	can tell where those go, and for groups nested deeper than MAX_ALIGNED_CHECK_DEPTH.
+	'''
+	if depth > MAX_ALIGNED_CHECK_DEPTH:
+		return None
+
+	num_columns = max(len(line) for line in ast_lines)
+	for line in ast_lines:
+		if 1 < len(line) < num_columns:
+			return None
+
+	widths = [0] * len(ast_lines)
 
 	for column_idx in range(num_columns):
-		# Find list nodes and convert to strings:
 		line_numbers = []
-		lists        = []
-
-		for line_nr, line_nodes in enumerate(in_ast_lines):
-			if type(line_nodes[column_idx]) is list:
+		for line_nr, line in enumerate(ast_lines):
+			if column_idx >= len(line) or line[column_idx] == '':
+				continue
+			if line[column_idx] == ' ':
+				if not is_spaces(texts[line_nr], bases[line_nr] + widths[line_nr], bases[line_nr] + widths[line_nr] + 1):
+					return None
+				widths[line_nr] += 1
+			else:
 				line_numbers.append(line_nr)
-				lists.append(line_nodes[column_idx])
 
-		if line_numbers:
-			aligned_lists = align_ast_lines(lists)
-			assert_is_list_of_strings(aligned_lists)
+		if not line_numbers:
+			continue
+
+		decimals = []
+		for line_nr in line_numbers:
+			node = ast_lines[line_nr][column_idx]
+			if isinstance(node, str):
+				decimals.append(annotate(node).decimal)
+			elif annotate(node[0]).decimal is None:
+				decimals.append(None)
+			else:
+				return None # A group opener that looks like a number - too fiddly to predict
+
+		rightmost_decimal = max([0] + [d for d in decimals if d is not None])
+		max_width = max(widths[line_nr] for line_nr in line_numbers)
+
+		group_lines = []
+		group_bases = []
+		for line_nr, decimal in zip(line_numbers, decimals):
+			start = max_width
+			if decimal is not None:
+				start += rightmost_decimal - decimal
+			text = texts[line_nr]
+			base = bases[line_nr]
+			if not is_spaces(text, base + widths[line_nr], base + start):
+				return None
+
+			node = ast_lines[line_nr][column_idx]
+			if isinstance(node, str):
+				if not text.startswith(node, base + start):
+					return None
+				widths[line_nr] = start + len(node)
+			else:
+				group_lines.append(line_nr)
+				group_bases.append(base + start)
+
+		if group_lines:
+			group_texts = [texts[line_nr] for line_nr in group_lines]
+			groups      = [ast_lines[line_nr][column_idx] for line_nr in group_lines]
+			group_ends  = aligned_ends(group_texts, group_bases, groups, depth + 1)
+			if group_ends is None:
+				return None
+			for line_nr, end in zip(group_lines, group_ends):
+				widths[line_nr] = end - bases[line_nr]
+
+	return [base + width for base, width in zip(bases, widths)]
+
 
-			for line_nr, aligned in zip(line_numbers, aligned_lists):
-				out_ast_lines[line_nr][column_idx] = aligned
+def is_spaces(text, begin, end):
+	''' True iff text[begin:end] is exactly end - begin spaces. '''
+	return end <= len(text) and text.count(' ', begin, end) == end - begin
+
+
+def align_ast_lines(ast_lines, options, report = None, deadline = None, pool = None, cache = None):
+	'''
+	Aligns lines of nodes into lines of strings.
+	The {groups} in each column are first aligned as a block of their own, and replaced with the result.
+	Blocks of groups are kept on an explicit stack rather than recursed into, so any nesting depth works.
+	'''
+	assert len(ast_lines) > 0
+	assert_is_list_of_nodes(ast_lines[0])
 
-	return out_ast_lines
+	# Each entry is (lines, group_columns) for a block still being unfolded,
+	# where group_columns is a stack of the (column_idx, line_numbers) of the groups in it.
+	blocks = [unfold_block(ast_lines, options, report, deadline, pool, cache)]
+
+	while True:
+		lines, group_columns = blocks[-1]
+
+		if group_columns:
+			column_idx, line_numbers = group_columns[-1]
+			groups = [lines[line_nr][column_idx] for line_nr in line_numbers]
+			blocks.append(unfold_block(groups, options, report, deadline, pool, cache))
+			continue
+
+		# All groups replaced with strings:
+		with measure(report, 'align columns'):
+			aligned = align_columns(lines)
+		assert_is_list_of_strings(aligned)
+		blocks.pop()
+
+		if not blocks:
+			return aligned
+
+		lines, group_columns = blocks[-1]
+		column_idx, line_numbers = group_columns.pop()
+		for line_nr, aligned_group in zip(line_numbers, aligned):
+			lines[line_nr][column_idx] = aligned_group
+
+
+def unfold_block(in_ast_lines, options, report = None, deadline = None, pool = None, cache = None):
+	'''
+	Adds phantom tokens to the lines, and finds the {groups} that need aligning.
+	Returns (lines, group_columns) for align_ast_lines, where lines are sparse (see expand_short_lines).
+	'''
+	with measure(report, 'phantom tokens'):
+		lines = expand_short_lines(in_ast_lines, options, deadline, pool, cache)
+
+	group_lines = {}
+	for line_nr, line_nodes in enumerate(lines):
+		for column_idx, node in line_nodes.items():
+			if type(node) is list:
+				group_lines.setdefault(column_idx, []).append(line_nr)
+
+	# We pop from the back, but want to go left to right:
+	group_columns = sorted(group_lines.items(), reverse = True)
+	return lines, group_columns
 
 
 def align_columns(lines):
+	'''
+	Aligns sparse lines ({column_idx: token}) into strings.
+	Only the tokens that are there are visited, so a single long line doesn't make the others expensive.
+	'''
 	assert len(lines) > 0
-	assert_is_list_of_strings(lines[0])
+	assert_is_sparse_lines_of_strings(lines)
 
 	# print("align_columns: {}".format(lines))
 
-	num_lines = len(lines)
-	num_columns = len(lines[0])
-	output = num_lines * ['']
+	columns = {} # column_idx -> [(line_nr, token)], in line order
+	for line_nr, line in enumerate(lines):
+		for column_idx, token in line.items():
+			columns.setdefault(column_idx, []).append((line_nr, token))
 
-	for column_idx in range(num_columns):
-		# Find space tokens and append:
-		for line_nr, line in enumerate(lines):
-			if line[column_idx] == ' ':
-				output[line_nr] += ' '
-				line[column_idx] = ''
+	output = len(lines) * ['']
 
-		# Find lines with non-empty tokens at this column:
+	for column_idx in sorted(columns):
+		# Append space tokens, and find lines with other tokens at this column:
 		line_numbers = []
 		tokens       = []
-		for line_nr, line in enumerate(lines):
-			assert isinstance(line[column_idx], str)
-			if line[column_idx] != '':
+		for line_nr, token in columns[column_idx]:
+			if token == ' ':
+				output[line_nr] += ' '
+			elif token != '':
 				line_numbers.append(line_nr)
-				tokens.append(line[column_idx])
+				tokens.append(token)
 
 		if tokens:
 			aligned_column = align_tokens(tokens)
@@ -489,74 +1448,107 @@ def is_operator_token(x):
 def substitution_cost_char(a, b):
 	if a == b:
 		return 0
-	elif re.match(RE_CHARACTER, a):
-		if re.match(RE_CHARACTER, b):
-			if a.isupper() == b.isupper():
-				return 1 # Same-case characters
-			else:
-				return 2 # Different-case character
-		elif re.match(RE_DIGIT, b):
-			return 3 # Character-Digit
-		else:
-			return 10 # Character-Symbol
-	elif re.match(RE_DIGIT, a):
-		if re.match(RE_DIGIT, b):
-			return 1 # Digit-digit
-		elif re.match(RE_CHARACTER, b):
-			return 2 # Digit-Character
-		else:
-			return 10 # Digit-Symbol
-	else:
-		if re.match(RE_DIGIT, b):
-			return 10 # Symbol-digit
-		elif re.match(RE_CHARACTER, b):
-			return 10 # Symbol-Character
-		else:
-			return 3 # Symbol-Symbol
+	return SUBSTITUTION_COST[a.translate(CHAR_CLASSES)][b.translate(CHAR_CLASSES)]
 
 
-def substitution_cost(s1, i1, s2, i2):
-	# We care less about the last character, e.g. trailing comma
-	is_last_char = i1 + 1 == len(s1) or i2 + 1 == len(s2)
-	cost = substitution_cost_char(s1[i1], s2[i2])
-	if is_last_char:
-		return min(cost, 1)
-	else:
-		return cost
+def add_del_costs(s):
+	''' The cost of adding or deleting each character of s '''
+	costs = [ADD_DEL_COST[c] for c in annotate(s).classes]
+	if costs:
+		costs[-1] = 1 # We care less about the last character, e.g. trailing comma
+	return costs
 
 
-def add_del_cost(s, i):
-	if i + 1 == len(s):
-		return 1 # We care less about the last character, e.g. trailing comma
-	c = s[i]
-	if re.match(RE_CHARACTER, c) or re.match(RE_DIGIT, c):
-		return 1
-	else:
-		return 10
+def levenshtein_distance(s1, s2, max_distance = None):
+	'''
+	If max_distance is given, gives up as soon as the distance is known to be larger (Ukkonen's cut-off),
+	and then returns some value larger than max_distance.
+	'''
+	if len(s1) < len(s2):
+		return levenshtein_distance(s2, s1, max_distance)
 
+	if max_distance is not None and len(s1) - len(s2) > max_distance:
+		return len(s1) - len(s2) # Each added character costs at least 1
 
-def levenshtein_distance(s1, s2):
-	if len(s1) < len(s2):
-		return levenshtein_distance(s2, s1)
+	classes1 = annotate(s1).classes
+	classes2 = annotate(s2).classes
+	add_del1 = add_del_costs(s1)
+	add_del2 = add_del_costs(s2)
+	last1    = len(s1) - 1
+	last2    = len(s2) - 1
 
 	previous_row = [0]
 	for i2 in range(len(s2)):
-		previous_row.append(previous_row[-1] + add_del_cost(s2, i2))
+		previous_row.append(previous_row[-1] + add_del2[i2])
 
 	for i1, c1 in enumerate(s1):
-		current_row = [previous_row[0] + add_del_cost(s1, i1)]
+		add_del_cost = add_del1[i1]
+		substitution_costs = SUBSTITUTION_COST[classes1[i1]]
+		current_row = [previous_row[0] + add_del_cost]
 		for i2, c2 in enumerate(s2):
-			addcost = previous_row[i2 + 1] + add_del_cost(s1, i1)
-			delcost = current_row[i2] + add_del_cost(s2, i2)
-			subcost = previous_row[i2] + substitution_cost(s1, i1, s2, i2)
+			if c1 == c2:
+				substitution_cost = 0
+			elif i1 == last1 or i2 == last2:
+				substitution_cost = 1 # We care less about the last character, e.g. trailing comma
+			else:
+				substitution_cost = substitution_costs[classes2[i2]]
+
+			addcost = previous_row[i2 + 1] + add_del_cost
+			delcost = current_row[i2] + add_del2[i2]
+			subcost = previous_row[i2] + substitution_cost
 			# print("'{}' '{}' add: {}, del: {}, sub: {}".format(c1, c2, addcost, delcost, subcost))
 			current_row.append(min(addcost, delcost, subcost))
 		# print("previous_row: {}".format(previous_row))
 		# print("current_row:  {}".format(current_row))
+		if max_distance is not None:
+			# Costs are never negative, so no later row can go below the best of this one:
+			closest = min(current_row)
+			if closest > max_distance:
+				return closest
 		previous_row = current_row
 	return previous_row[-1]
 
 
+# Tokens longer than this, like long string literals, are compared with approximate_distance instead.
+APPROXIMATE_TOKEN_LENGTH = 48
+
+
+def approximate_distance(s1, s2):
+	'''
+	A cheap stand-in for levenshtein_distance of long tokens, in O(len) rather than O(len^2).
+	The common prefix and suffix cost nothing, as in levenshtein_distance.
+	What is left of each token is then compared as a bag of characters, ignoring their order:
+	characters of the same class are substituted for each other, and the rest are added or deleted.
+	Like levenshtein_distance, it is at least the difference in length.
+	'''
+	shortest = min(len(s1), len(s2))
+	prefix = 0
+	while prefix < shortest and s1[prefix] == s2[prefix]:
+		prefix += 1
+	suffix = 0
+	while prefix + suffix < shortest and s1[-1 - suffix] == s2[-1 - suffix]:
+		suffix += 1
+	middle1 = s1[prefix:len(s1) - suffix]
+	middle2 = s2[prefix:len(s2) - suffix]
+
+	# Characters in only one of the middles:
+	extra1 = collections.Counter(middle1)
+	extra2 = collections.Counter(middle2)
+	extra1, extra2 = extra1 - extra2, extra2 - extra1
+	classes1 = collections.Counter(annotate(''.join(extra1.elements())).classes)
+	classes2 = collections.Counter(annotate(''.join(extra2.elements())).classes)
+
+	distance = 0
+	for class1, class2 in [('A', 'A'), ('a', 'a'), ('.', '.'), ('A', 'a'), ('a', 'A')]:
+		substitutions = min(classes1[class1], classes2[class2])
+		distance += substitutions * SUBSTITUTION_COST[class1][class2]
+		classes1[class1] -= substitutions
+		classes2[class2] -= substitutions
+	for char_class, cost in ADD_DEL_COST.items():
+		distance += (classes1[char_class] + classes2[char_class]) * cost
+	return distance
+
+
 # -----------------------------------------------------------------------------
 
 
@@ -564,11 +1556,21 @@ def character_similarity(a, b):
 	return 10 - substitution_cost_char(a, b)
 
 
-def token_similarity(a, b):
-	assert isinstance(a, str)
-	assert isinstance(b, str)
+def first_character_similarity(a, b):
+	''' character_similarity of the first characters of two non-empty Tokens '''
+	if a[0] == b[0]:
+		return 10
+	return 10 - SUBSTITUTION_COST[a.classes[0]][b.classes[0]]
+
 
+def token_similarity(a, b, min_similarity = None):
+	'''
+	If min_similarity is given, the result is only exact if it is at least min_similarity.
+	Anything less dissimilar than that may be cut short, returning some value below min_similarity.
+	'''
 	# print("token_similarity '{}' vs '{}'".format(a, b))
+	a = annotate(a)
+	b = annotate(b)
 
 	# Special case to prevent this:
 	#     string mushroom = badger;
@@ -576,7 +1578,7 @@ def token_similarity(a, b):
 	# And this:
 	#     print a + b;
 	#     print     c;
-	if a != b and (is_operator_token(a) or is_operator_token(b)):
+	if a != b and (a.kind == 'operator' or b.kind == 'operator'):
 		return -1000
 
 	if a == '' or b == '':
@@ -588,7 +1590,7 @@ def token_similarity(a, b):
 	similarity = 0
 
 	# Similarity in the first character weighs more heavily than other characters
-	similarity += 100 * character_similarity(a[0], b[0])
+	similarity += 100 * first_character_similarity(a, b)
 
 	# Check last character? The problem then is that we want
 	#    x, y
@@ -607,7 +1609,15 @@ def token_similarity(a, b):
 	# 	similarity += 200
 
 	# Take word similarity into account:
-	similarity -= 10 * levenshtein_distance(a, b);
+	if len(a) > APPROXIMATE_TOKEN_LENGTH and len(b) > APPROXIMATE_TOKEN_LENGTH:
+		similarity -= 10 * approximate_distance(a, b)
+	elif min_similarity is None:
+		similarity -= 10 * levenshtein_distance(a, b);
+	else:
+		max_distance = (similarity - min_similarity) // 10
+		if max_distance < 0:
+			return similarity - 10 * abs(len(a) - len(b)) - 1 # Below min_similarity whatever the distance
+		similarity -= 10 * levenshtein_distance(a, b, max_distance)
 
 	# Use token length as a tie-breaker:
 	# similarity -= abs(len(a) - len(b))
@@ -615,11 +1625,128 @@ def token_similarity(a, b):
 	return similarity
 
 
+def similarity_upper_bound(a, b):
+	'''
+	A cheap upper bound of token_similarity(a, b).
+	Skips the levenshtein distance, except for a lower bound of it: every added or deleted character costs at least 1.
+	'''
+	a = annotate(a)
+	b = annotate(b)
+
+	if a != b and (a.kind == 'operator' or b.kind == 'operator'):
+		return -1000
+
+	if a == '' or b == '':
+		return 0
+
+	return 100 * first_character_similarity(a, b) - 10 * abs(len(a) - len(b))
+
+
 def collapse_node(node):
+	''' The node as a string, with a space between children. '''
 	if isinstance(node, str):
 		return node
-	else:
-		return " ".join((collapse_node(child) for child in node))
+
+	parts = []
+	children = [iter(node)] # Iterators over the groups we are in
+	need_space = [False]
+	while children:
+		child = next(children[-1], None)
+		if child is None:
+			children.pop()
+			need_space.pop()
+			continue
+
+		if need_space[-1]:
+			parts.append(' ')
+		need_space[-1] = True
+
+		if isinstance(child, str):
+			parts.append(child)
+		else:
+			children.append(iter(child))
+			need_space.append(False)
+
+	return ''.join(parts)
+
+
+# Groups with more text than APPROXIMATE_TOKEN_LENGTH are compared by their structure rather than their text:
+# their opener and the first token of each of their first SUMMARY_CHILDREN children.
+SUMMARY_CHILDREN = 3
+
+
+class NodeSummaries(object):
+	'''
+	What the phantom token search compares nodes by, worked out once per node.
+	Nodes are remembered by id, so they must outlive this.
+	The summary of a node is (text, rest_length, rest_children).
+	For a token or small group, text is all of collapse_node(node) and nothing is left over.
+	For a big group, text is its opener and the first tokens of its first few children,
+	and the rest of collapse_node(node) is rest_length characters in rest_children more children.
+	'''
+
+	def __init__(self):
+		self._lengths   = {}
+		self._summaries = {}
+
+	def length(self, node):
+		''' len(collapse_node(node)) '''
+		if isinstance(node, str):
+			return len(node)
+
+		groups = [node] # Groups to measure, each after the groups in it
+		while groups:
+			group = groups[-1]
+			if id(group) in self._lengths:
+				groups.pop()
+				continue
+			unmeasured = [child for child in group if not isinstance(child, str) and id(child) not in self._lengths]
+			if unmeasured:
+				groups += unmeasured
+				continue
+			groups.pop()
+			self._lengths[id(group)] = sum(self.length(child) for child in group) + max(len(group) - 1, 0)
+		return self._lengths[id(node)]
+
+	def summary(self, node):
+		if isinstance(node, str):
+			return (annotate(node), 0, 0)
+
+		summary = self._summaries.get(id(node))
+		if summary is None:
+			length = self.length(node)
+			if length <= APPROXIMATE_TOKEN_LENGTH:
+				summary = (annotate(collapse_node(node)), 0, 0)
+			else:
+				children = [child for child in node[1:] if child != ' ']
+				tokens = []
+				for child in [node[0]] + children[:SUMMARY_CHILDREN]:
+					while not isinstance(child, str):
+						child = child[0] # The opener of a group
+					tokens.append(child)
+				text = ' '.join(tokens)
+				summary = (annotate(text), length - len(text), len(children) - (len(tokens) - 1))
+			self._summaries[id(node)] = summary
+		return summary
+
+
+def summary_similarity(a, b, min_similarity = None, similar = token_similarity):
+	'''
+	The similarity of two nodes from their NodeSummaries: similar(text_a, text_b, min_similarity),
+	less 10 for each character and child that one has left over and the other has not.
+	Like token_similarity, the result is only exact if it is at least min_similarity.
+	'''
+	text_a, length_a, children_a = a
+	text_b, length_b, children_b = b
+	penalty = 10 * (abs(length_a - length_b) + abs(children_a - children_b))
+	if min_similarity is not None:
+		min_similarity += penalty
+	return similar(text_a, text_b, min_similarity) - penalty
+
+
+def summary_similarity_bound(a, b):
+	''' A cheap upper bound of summary_similarity(a, b) (see similarity_upper_bound) '''
+	return similarity_upper_bound(a[0], b[0]) - 10 * (abs(a[1] - b[1]) + abs(a[2] - b[2]))
 
 
 def node_similarity(a, b):
@@ -636,7 +1763,7 @@ def calc_similarity(line_a, line_b):
 
 
 # Add phantom tokens to "short_line"
-def expand_short_line(long_line, short_line):
+def expand_short_line(long_line, short_line, options, deadline = None, cache = None, summaries = None):
 	assert_is_list_of_nodes(long_line)
 	assert_is_list_of_nodes(short_line)
 
@@ -646,7 +1773,7 @@ def expand_short_line(long_line, short_line):
 	if len(short_line) <= 1:
 		return short_line
 
-	return [short_line[0]] + expand_line_ending(long_line[1:], short_line[1:])
+	return [short_line[0]] + expand_line_ending(long_line[1:], short_line[1:], options, deadline, cache, summaries)
 
 
 def dynamic_similarity(context, a, b):
@@ -663,23 +1790,43 @@ def dynamic_similarity(context, a, b):
 	assert left_of_long >= left_of_short
 
 	if similarity[a][b] is None:
-		match_similarity  = node_similarity(long_line[a], short_line[b]) + dynamic_similarity(context, a + 1, b + 1)[0]
+		if context["deadline"] is not None and time.monotonic() >= context["deadline"]:
+			raise DeadlineExceeded()
 
 		if left_of_long <= left_of_short:
 			# print("We should match at {}/{}".format(a,b))
-			similarity[a][b] = (match_similarity, True)
+			similarity[a][b] = (match_similarity(context, a, b), True)
 			assert similarity[a][b][1]
 		else:
-			insert_similarity = node_similarity(long_line[a], '')            + dynamic_similarity(context, a + 1, b + 0)[0]
-			insert_similarity -= 1 # Small penalty for inserts
+			# Branch and bound: evaluate the most promising option first,
+			# and skip the other one if its upper bound can't beat it.
+			# Ties go to matching.
+			rest_bound   = context["rest_bound"]
+			match_bound  = summary_similarity_bound(context["long_summaries"][a], context["short_summaries"][b]) + rest_bound[b + 1]
+			insert_bound = token_similarity(context["long_summaries"][a][0], '') - 1 + rest_bound[b]
+
+			if match_bound >= insert_bound:
+				match_sim = match_similarity(context, a, b)
+				if insert_bound <= match_sim:
+					should_match = True
+				else:
+					insert_sim   = insert_similarity(context, a, b)
+					should_match = match_sim >= insert_sim
+			else:
+				insert_sim = insert_similarity(context, a, b)
+				if match_bound < insert_sim:
+					should_match = False
+				else:
+					match_sim    = match_similarity(context, a, b, insert_sim)
+					should_match = match_sim >= insert_sim
 
-			if match_similarity >= insert_similarity:
+			if should_match:
 				# print("We should match at {}/{}".format(a,b))
-				similarity[a][b] = (match_similarity, True)
+				similarity[a][b] = (match_sim, True)
 				assert similarity[a][b][1]
 			else:
 				# print("We should insert at {}/{}".format(a,b))
-				similarity[a][b] = (insert_similarity, False)
+				similarity[a][b] = (insert_sim, False)
 
 	should_match = similarity[a][b][1]
 	if not should_match:
@@ -688,7 +1835,50 @@ def dynamic_similarity(context, a, b):
 	return similarity[a][b]
 
 
-def expand_line_ending(long_line, short_line):
+def match_similarity(context, a, b, insert_similarity = None):
+	'''
+	Best similarity if we match long_line[a] with short_line[b].
+	If insert_similarity is given, the result is only exact if it is at least that,
+	else it may be any value below it.
+	'''
+	long_summary  = context["long_summaries"][a]
+	short_summary = context["short_summaries"][b]
+	rest = dynamic_similarity(context, a + 1, b + 1)[0]
+	similar = token_similarity if context["cache"] is None else context["cache"].token_similarity
+
+	if insert_similarity is not None:
+		bound = summary_similarity_bound(long_summary, short_summary) + rest
+		if bound < insert_similarity:
+			return bound
+		# Only the exact similarity of a winning match matters:
+		return summary_similarity(long_summary, short_summary, insert_similarity - rest, similar) + rest
+
+	return summary_similarity(long_summary, short_summary, similar = similar) + rest
+
+
+def insert_similarity(context, a, b):
+	''' Best similarity if we insert a phantom token before short_line[b] to go with long_line[a]. '''
+	similarity  = token_similarity(context["long_summaries"][a][0], '') + dynamic_similarity(context, a + 1, b + 0)[0]
+	similarity -= 1 # Small penalty for inserts
+	return similarity
+
+
+def rest_similarity_bounds(long_summaries, short_summaries):
+	'''
+	bounds[b] is an upper bound of dynamic_similarity(context, a, b) for any a.
+	Each remaining short token gets matched with some long token within reach of it,
+	and inserted phantom tokens can only lower the similarity.
+	'''
+	num_inserts = len(long_summaries) - len(short_summaries)
+	bounds = [0] * (len(short_summaries) + 1)
+	for b in reversed(range(len(short_summaries))):
+		best = max(summary_similarity_bound(long_summaries[a], short_summaries[b])
+		           for a in range(b, b + num_inserts + 1))
+		bounds[b] = bounds[b + 1] + best
+	return bounds
+
+
+def expand_line_ending(long_line, short_line, options, deadline = None, cache = None, summaries = None):
 	# We want to insert '' tokens into short_line in places so as to
 	# maximize its similarity to long_line, as defined by calc_similarity.
 	# This is a dynamic programming problem. Let's make a NxN table
@@ -702,10 +1892,22 @@ def expand_line_ending(long_line, short_line):
 	similarity = [[None for x in range(N)] for y in range(N)]
 	assert id(similarity[0]) != id(similarity[1])
 
+	summaries       = summaries or NodeSummaries()
+	long_summaries  = [summaries.summary(node) for node in long_line]
+	short_summaries = [summaries.summary(node) for node in short_line]
+	assert_is_list_of_summaries(long_summaries) # Their texts are what token_similarity is given
+	assert_is_list_of_summaries(short_summaries)
+
 	context = {
-		"long_line":  long_line,
-		"short_line": short_line,
-		"similarity": similarity,
+		"long_line":       long_line,
+		"short_line":      short_line,
+		"long_summaries":  long_summaries,  # What summary_similarity compares
+		"short_summaries": short_summaries,
+		"rest_bound":      rest_similarity_bounds(long_summaries, short_summaries),
+		"similarity":      similarity,
+		"options":         options,
+		"deadline":        deadline,        # time.monotonic() to give up at, or None
+		"cache":           cache,           # A BlockCache to remember token similarities in, or None
 	}
 
 	# print("long line:  {}".format(long_line))
@@ -747,22 +1949,70 @@ def expand_line_ending(long_line, short_line):
 	# map<x, y> foo;
 	# int       bar;
 # By inserting a phantom token between "int" and "bar" to align with "y>"
-# This function returns equally long lines (measured in Ast Ndoes)
-def expand_short_lines(in_lines):
+# This function returns sparse lines: {column_idx: node} of just the real nodes,
+# so that short lines cost nothing for the columns they don't reach.
+# Lines with phantom tokens can be found in parallel, since each short line is only compared to the longest one.
+# So given a multiprocessing pool, big blocks are split into shards of SHARD_LINES lines, each expanded by a worker.
+def expand_short_lines(in_lines, options, deadline = None, pool = None, cache = None):
 	assert isinstance(in_lines, list)
 	assert_is_list_of_nodes(in_lines[0])
 
 	longest_line = max(in_lines, key=len)
 
+	if pool is not None and options.phantom_tokens and len(in_lines) > SHARD_LINES:
+		if any(1 < len(line) < len(longest_line) for line in in_lines):
+			try:
+				return expand_short_lines_sharded(in_lines, longest_line, options, deadline, pool)
+			except RecursionError:
+				pass # Too deeply nested to send to the pool: do it here
+
 	expanded = []
+	summaries = NodeSummaries() # Of the nodes of all lines, so those of the longest line are only summarized once
 	for line in in_lines:
-		expanded_line = expand_short_line(longest_line, line)
-		while len(expanded_line) < len(longest_line):
-			expanded_line.append('')
-		expanded.append(expanded_line)
+		if options.phantom_tokens:
+			line = expand_short_line(longest_line, line, options, deadline, cache, summaries)
+		expanded.append(dict((column_idx, node) for column_idx, node in enumerate(line) if node != ''))
+	return expanded
+
+
+SHARD_LINES = 256
+
+
+def expand_short_lines_sharded(in_lines, longest_line, options, deadline, pool):
+	'''
+	expand_short_lines, with the lines split into shards that the pool expands in parallel.
+	Workers get the nodes as plain strings, which are much cheaper to send than Tokens,
+	and send back only the column of each node, which are combined with our own nodes here.
+	'''
+	longest_line = plain_node(longest_line)
+	shards = [(longest_line, [plain_node(line) for line in in_lines[first:first + SHARD_LINES]], options, deadline)
+	          for first in range(0, len(in_lines), SHARD_LINES)]
+
+	expanded = []
+	line_nr = 0
+	for shard_columns in pool.map(phantom_columns, shards):
+		for columns in shard_columns:
+			nodes = [node for node in in_lines[line_nr] if node != '']
+			expanded.append(dict(zip(columns, nodes)))
+			line_nr += 1
 	return expanded
 
 
+def phantom_columns(shard):
+	''' Worker of expand_short_lines_sharded: the column of each (non-empty) node of each line in the shard '''
+	longest_line, lines, options, deadline = shard
+	summaries = NodeSummaries()
+	return [[column_idx for column_idx, node in enumerate(expand_short_line(longest_line, line, options, deadline, summaries = summaries)) if node != '']
+	        for line in lines]
+
+
+def plain_node(node):
+	''' A copy of node with plain strings instead of Tokens '''
+	if isinstance(node, str):
+		return str(node)
+	return [plain_node(child) for child in node]
+
+
 def spaces(num):
 	return num * ' '
 
@@ -784,15 +2034,9 @@ def align_tokens(tokens):
 	# align_width           = 0
 
 	for ix, token in enumerate(tokens):
-		is_number = RE_NUMBER.match(token)
+		decimal_place[ix] = annotate(token).decimal
 
-		if is_number:
-			decimal_place[ix] = 0
-			for c in token:
-				if RE_SIGN_OR_DIGIT.match(c):
-					decimal_place[ix] += 1
-				else:
-					break
+		if decimal_place[ix] != None:
 			spam("Number '%s' has decimal at %i" % (token, decimal_place[ix]))
 			rightmost_decimal     = max(rightmost_decimal,     decimal_place[ix])
 			# right_side_of_decimal = max(right_side_of_decimal, len(token) - decimal_place[ix])
@@ -819,24 +2063,668 @@ def align_tokens(tokens):
 	return aligned_lines
 
 
+# -----------------------------------------------------------------------------
+# Alignment plans: align once, then render more rows the same way.
+
+
+class AlignmentPlan(object):
+	'''
+	How a block of rows was aligned, so that more rows like them can be aligned the same way
+	without aligning the whole block again. Meant for log formatters, table writers and the like.
+		starts:        {column: where its tokens start}
+		decimals:      {column: how far from its start the decimal points of numbers go}
+		comment_start: where trailing comments start, or None
+	Rows are lines without indentation, and {groups} in them are kept as written rather than aligned inside.
+	Rows shorter than the longest row are matched to its columns with phantom tokens once per signature
+	(the kind and first character class of each token and the length of numbers, see _signature).
+	Rows with the same signature share columns, so applying the plan to rows like those it has seen is just string formatting.
+
+		plan = AlignmentPlan(rows)
+		plan.extend(more_rows) # Only needed if they might not fit
+		lines = plan.apply(more_rows)
+	'''
+
+	def __init__(self, rows, options = None):
+		self.options       = options or default_options()
+		self.longest       = []
+		self.starts        = {}
+		self.decimals      = {}
+		self.comment_start = None
+		self._examples     = {}    # signature -> nodes of the first row seen with it
+		self._columns      = {}    # signature -> the column of each node, against the longest row
+		self._rows         = set() # (signature, (len, decimal) of each token or None for spaces, has comment) of the rows extended with
+		self._gaps         = {}    # (column, next column or None for the comment, is number) -> widest gap between their starts
+		self.extend(rows)
+
+	def extend(self, rows):
+		'''
+		Widens the columns where needed for the given rows to fit, like alignify would.
+		Returns True iff anything moved, in which case rows rendered before no longer line up with new ones.
+		'''
+		old = (self.starts, self.comment_start, dict(self.decimals))
+		longest = self.longest
+		new_rows = []
+		for row in rows:
+			nodes, comment = self._parse(row)
+			if len(nodes) > len(self.longest):
+				self.longest = nodes
+			signature = self._signature(nodes)
+			self._examples.setdefault(signature, nodes)
+			widths = tuple(None if token == ' ' else (len(token), token.decimal) for token in nodes)
+			record = (signature, widths, bool(comment))
+			if record not in self._rows:
+				self._rows.add(record)
+				new_rows.append(record)
+
+		if self.longest is not longest:
+			# The columns are numbered after the longest row, so everything is placed anew:
+			self._columns  = {}
+			self._gaps     = {}
+			self.decimals  = {}
+			new_rows = self._rows
+		for record in new_rows:
+			self._add_gaps(*record)
+
+		self._place()
+		return (self.starts, self.comment_start, self.decimals) != old
+
+	def apply(self, rows):
+		'''
+		Renders the rows with the planned columns and returns them as strings.
+		Rows that don't fit (see extend) are pushed right where they need to be, and won't line up.
+		'''
+		output = []
+		for row in rows:
+			nodes, comment = self._parse(row)
+			signature = self._signature(nodes)
+			self._examples.setdefault(signature, nodes)
+			columns = self._columns_of(signature)
+
+			line = ''
+			for column_idx, token in zip(columns, nodes):
+				if token == ' ':
+					line += ' '
+					continue
+				line += spaces(self.starts.get(column_idx, 0) - len(line))
+				if token.decimal is not None:
+					line += spaces(self.decimals.get(column_idx, token.decimal) - token.decimal)
+				line += token
+
+			if comment:
+				line += spaces((self.comment_start or 0) - len(line)) + comment
+			output.append(line)
+		return output
+
+	def _add_gaps(self, signature, widths, has_comment):
+		''' Records the gaps between the columns of a row (a record of self._rows), and the decimal points of its numbers '''
+		prev, prev_is_number, gap = -1, False, 0
+		for column_idx, width in zip(self._columns_of(signature), widths):
+			if width is None:
+				gap += 1 # A space
+				continue
+			key = (prev, column_idx, prev_is_number)
+			self._gaps[key] = max(self._gaps.get(key, 0), gap)
+
+			length, decimal = width
+			prev, prev_is_number = column_idx, decimal is not None
+			if prev_is_number:
+				self.decimals[column_idx] = max(self.decimals.get(column_idx, 0), decimal)
+				gap = length - decimal
+			else:
+				gap = length
+
+		if has_comment:
+			key = (prev, None, prev_is_number)
+			self._gaps[key] = max(self._gaps.get(key, 0), gap)
+
+	def _parse(self, row):
+		''' (nodes, comment) of a row, with {groups} collapsed into tokens '''
+		nodes = [node if isinstance(node, str) else annotate(collapse_node(node)) for node in parse(row)[0]]
+		comment = strip_comments([nodes])[0]
+		return nodes, comment
+
+	def _signature(self, nodes):
+		'''
+		What rows are matched to columns by: the kind and first character class of each token, and the length of numbers,
+		since a short number is placed differently from a long one.
+		'''
+		return tuple((token.kind, token.classes[:1], None if token.decimal is None else len(token)) for token in nodes)
+
+	def _columns_of(self, signature):
+		''' The column of each node of rows with the signature, found with _expand the first time '''
+		columns = self._columns.get(signature)
+		if columns is None:
+			columns = self._columns[signature] = self._expand(self._examples[signature])
+		return columns
+
+	def _expand(self, nodes):
+		''' The column of each node, from phantom tokens against the longest row '''
+		if len(nodes) >= len(self.longest):
+			return list(range(len(nodes)))
+		expanded = expand_short_line(self.longest, nodes, self.options)
+		return [column_idx for column_idx, node in enumerate(expanded) if node != '']
+
+	def _place(self):
+		''' Puts each column as far left as the widest gap to any column before it allows '''
+		starts = {-1: 0}
+		comment_start = None
+		for (prev, column_idx, prev_is_number), gap in sorted(self._gaps.items(), key = lambda item: (item[0][1] is None, item[0][1])):
+			start = starts[prev] + gap
+			if prev_is_number:
+				start += self.decimals[prev]
+			if column_idx is None:
+				comment_start = max(comment_start or 0, start)
+			else:
+				starts[column_idx] = max(starts.get(column_idx, 0), start)
+		del starts[-1]
+		self.starts = starts
+		self.comment_start = comment_start
+
+
+# -----------------------------------------------------------------------------
+# Table mode: delimiter-separated rows (CSV, TSV, Markdown tables), without parsing or phantom tokens.
+
+
+RE_MARKDOWN_RULE = re.compile(r'^:?-+:?$')
+
+
+def split_row(line, delimiter):
+	'''
+	The cells of a row, with surrounding whitespace stripped.
+	Delimiters inside double quotes don't count. For Markdown rows (starting with |), the outer pipes are dropped.
+	A whitespace delimiter (like a tab) is kept at the ends of the line, so empty cells there aren't lost.
+	'''
+	line = line.strip(' ') if delimiter.isspace() else line.strip()
+	if delimiter == '|' and line.startswith('|'):
+		line = line[1:-1] if line.endswith('|') and len(line) > 1 else line[1:]
+
+	if '"' not in line:
+		return [cell.strip() for cell in line.split(delimiter)]
+
+	cells = []
+	begin = 0
+	quoted = False
+	for ix, c in enumerate(line):
+		if c == '"':
+			quoted = not quoted
+		elif c == delimiter and not quoted:
+			cells.append(line[begin:ix].strip())
+			begin = ix + 1
+	cells.append(line[begin:].strip())
+	return cells
+
+
+def is_markdown_rule(cells):
+	''' Is this the |---|:--:| row under the header of a Markdown table? '''
+	return all(RE_MARKDOWN_RULE.match(cell) for cell in cells)
+
+
+def table_widths(lines, delimiter):
+	'''
+	First pass of align_table: [(widest plain cell, rightmost decimal point, widest part of a number from its decimal point)] per column.
+	Markdown tables with a |---| rule get columns at least 3 wide, since that is the shortest rule cell.
+	'''
+	plains   = []
+	decimals = []
+	afters   = []
+	has_rule = False
+	for line in lines:
+		if line.strip() == '':
+			continue
+		cells = split_row(line, delimiter)
+		if delimiter == '|' and is_markdown_rule(cells):
+			has_rule = True
+			continue
+		while len(plains) < len(cells):
+			plains.append(0)
+			decimals.append(0)
+			afters.append(0)
+		for column_idx, cell in enumerate(cells):
+			decimal_place = None if cell[:1].isalpha() else find_decimal_place(cell) # Numbers never start with a letter
+			if decimal_place is None:
+				if len(cell) > plains[column_idx]:
+					plains[column_idx] = len(cell)
+			else:
+				if decimal_place > decimals[column_idx]:
+					decimals[column_idx] = decimal_place
+				if len(cell) - decimal_place > afters[column_idx]:
+					afters[column_idx] = len(cell) - decimal_place
+	if has_rule:
+		plains = [max(plain, 3) for plain in plains]
+	return list(zip(plains, decimals, afters))
+
+
+def render_row(line, delimiter, widths):
+	'''
+	Second pass of align_table: a row aligned to the widths from table_widths.
+	Numbers are aligned on their decimal point, like align_tokens does.
+	Markdown rows get a space on either side of each |, with or without the outer pipes,
+	and no row ends with padding.
+	'''
+	if line.strip() == '':
+		return line
+	cells = split_row(line, delimiter)
+	markdown = delimiter == '|'
+	rule = markdown and is_markdown_rule(cells)
+
+	out = []
+	for column_idx, cell in enumerate(cells):
+		plain, decimal, after = widths[column_idx] if column_idx < len(widths) else (len(cell), 0, 0)
+		width = max(plain, decimal + after)
+		if rule:
+			dashes = '-' * (width - cell.startswith(':') - cell.endswith(':'))
+			cell = (':' if cell.startswith(':') else '') + dashes + (':' if cell.endswith(':') else '')
+		elif decimal + after > 0 and not cell[:1].isalpha(): # Could it be a number, in a column with numbers?
+			decimal_place = find_decimal_place(cell)
+			if decimal_place is not None:
+				cell = spaces(decimal - decimal_place) + cell
+		out.append((cell, width))
+
+	if markdown and line.lstrip().startswith('|'):
+		return '| ' + ' | '.join(cell + spaces(width - len(cell)) for cell, width in out) + ' |'
+
+	if markdown:
+		columns = [cell + spaces(width - len(cell)) + ' | ' for cell, width in out[:-1]]
+	elif delimiter.isspace():
+		# Padding after a tab would jump to the next tab stop, so pad before it instead:
+		columns = [cell + spaces(width - len(cell)) + delimiter for cell, width in out[:-1]]
+	else:
+		columns = [cell + delimiter + spaces(width - len(cell)) + ' ' for cell, width in out[:-1]]
+	return (''.join(columns) + out[-1][0]).rstrip(' ') # The last cell may be empty
+
+
+class FileLines(object):
+	''' The lines of a file (without line endings), read anew each time they are iterated over '''
+
+	def __init__(self, file_name):
+		self.file_name = file_name
+
+	def __iter__(self):
+		with open(self.file_name) as f:
+			for line in f:
+				yield line.rstrip('\r\n')
+
+
+def align_table(lines, delimiter = ','):
+	'''
+	Aligns delimiter-separated rows, column by column, and yields the aligned lines.
+	lines is read twice (first for the column widths), so pass a list, a FileLines, or something else that can be iterated twice.
+	Padding goes after the delimiter, so that values read the same after stripping whitespace,
+	except with a whitespace delimiter (like a tab), where it goes before it so that the delimiters line up.
+	'''
+	widths = table_widths(lines, delimiter)
+	for line in lines:
+		yield render_row(line, delimiter, widths)
+
+
 def print_help():
-	print("alignify.py [file_name_1, ...],  or:  cat text | alignify.py")
+	print("alignify.py [--check] [--diff PATCH] [--print-diff] [--watch] [--max-memory SIZE] [--max-seconds SECONDS] [--segment] [--table DELIMITER] [--validate LEVEL] [--jobs N] [file_name_1, ...],  or:  cat text | alignify.py")
+
+
+def read_lines(file_name):
+	''' Lines of the given file (or stdin for '-'), without line endings. '''
+	import sys
+
+	if file_name == '-':
+		text = sys.stdin.read()
+	else:
+		with open(file_name) as f:
+			text = f.read()
+
+	lines = text.split('\n')
+	if text.endswith('\n'):
+		lines.pop()
+	return lines
+
+
+def parse_unified_diff(diff_lines):
+	'''
+	Returns {file_name: [line numbers]} of the lines a unified diff touches in the new version of each file.
+	Line numbers are 0-based. Where lines were only removed (not replaced), the lines on either side count as touched.
+	'''
+	import os
+
+	touched   = {}
+	line_nrs  = None
+	old_left  = 0
+	new_left  = 0
+	line_nr   = 0
+	removed   = False # Inside a run of - lines that no + lines have followed yet
+
+	for line in diff_lines:
+		if old_left > 0 or new_left > 0:
+			# Inside a hunk:
+			if line.startswith('+'):
+				line_nrs.append(line_nr)
+				line_nr  += 1
+				new_left -= 1
+				removed   = False
+			elif line.startswith('-'):
+				old_left -= 1
+				removed   = True
+			elif line.startswith('\\'):
+				pass # \ No newline at end of file
+			else:
+				if removed:
+					line_nrs += [line_nr - 1, line_nr]
+					removed = False
+				line_nr  += 1
+				old_left -= 1
+				new_left -= 1
+
+			if removed and old_left <= 0 and new_left <= 0:
+				line_nrs += [line_nr - 1, line_nr] # The hunk ends with the removal
+				removed = False
+			continue
+
+		if line.startswith('+++ '):
+			file_name = line[4:].split('\t')[0].strip()
+			if file_name == '/dev/null':
+				line_nrs = None # Deleted file
+				continue
+			if file_name.startswith('b/') and not os.path.exists(file_name):
+				file_name = file_name[2:] # git-style prefix
+			line_nrs = touched.setdefault(file_name, [])
+
+		elif line.startswith('@@ ') and line_nrs is not None:
+			m = re.match(r'@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', line)
+			if m:
+				old_left = int(m.group(1)) if m.group(1) is not None else 1
+				new_left = int(m.group(3)) if m.group(3) is not None else 1
+				line_nr  = int(m.group(2)) - 1
+				if new_left == 0:
+					line_nr += 1 # For pure deletions, the position is that of the line before
+
+	return touched
+
+
+def parse_size(text):
+	''' '512K', '200M', '2G' or plain bytes -> bytes '''
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+	text = text.strip().upper().rstrip('B')
+	if text and text[-1] in units:
+		return int(float(text[:-1]) * units[text[-1]])
+	return int(text)
+
+
+def print_report(report, file_name = None):
+	''' Prints degraded blocks and peak memory per phase to stderr '''
+	import sys
+
+	for line_nr, reason in report.degraded:
+		if file_name:
+			sys.stderr.write("{}:{}: {}\n".format(file_name, line_nr + 1, reason))
+		else:
+			sys.stderr.write("line {}: {}\n".format(line_nr + 1, reason))
+
+	for phase, peak in sorted(report.phase_peaks.items()):
+		sys.stderr.write("peak memory during {:<15} {:>10.1f} KiB\n".format(phase + ':', peak / 1024.0))
+
+
+def check_files(file_names, touched = None, options = None, cache = None):
+	'''
+	Prints file:line for the first unaligned block of each file.
+	If touched ({file_name: [line numbers]}) is given, only checks the blocks with those lines.
+	Returns True iff all files are aligned.
+	'''
+	all_aligned = True
+	for file_name in file_names:
+		line_nrs = touched[file_name] if touched is not None else None
+		report = Report()
+		line_nr = find_unaligned_line(read_lines(file_name), line_nrs, options, report, cache)
+		print_report(report, file_name)
+		if line_nr is not None:
+			print("{}:{}: not aligned".format(file_name, line_nr + 1))
+			all_aligned = False
+	return all_aligned
+
+
+def print_diffs(file_names, touched = None, options = None, cache = None):
+	'''
+	Prints a unified diff of how each file would be aligned.
+	If touched ({file_name: [line numbers]}) is given, only the blocks with those lines are aligned.
+	Returns True iff there were no changes.
+	'''
+	import sys
+
+	unchanged = True
+	for file_name in file_names:
+		line_nrs = touched[file_name] if touched is not None else None
+		report = Report()
+		for line in unified_diff(read_lines(file_name), file_name, line_nrs, options = options, report = report, cache = cache):
+			sys.stdout.write(line + '\n')
+			unchanged = False
+		print_report(report, file_name)
+	return unchanged
+
+
+def align_touched_files(touched, options = None, cache = None):
+	'''
+	Realigns, in place, the blocks with the given lines ({file_name: [line numbers]}).
+	Every other byte of the files is left as it was.
+	'''
+	import io
+
+	for file_name, line_nrs in sorted(touched.items()):
+		with io.open(file_name, newline='') as f:
+			text = f.read()
+
+		if '\r\n' in text and text.count('\r\n') == text.count('\n'):
+			newline = '\r\n'
+		else:
+			newline = '\n'
+
+		lines = text.split(newline)
+		report = Report()
+		aligned = alignify_touched_lines(lines, line_nrs, options, report, cache)
+		print_report(report, file_name)
+		if aligned != lines:
+			with io.open(file_name, 'w', newline='') as f:
+				f.write(newline.join(aligned))
+
+
+def changed_line_nrs(old_lines, new_lines):
+	'''
+	The line numbers in new_lines that differ from old_lines: the replaced and inserted lines of a line diff.
+	Where lines were only removed, the lines on either side count as changed.
+	Lines between two separate edits are left out, so their blocks aren't realigned.
+	'''
+	import difflib
+
+	line_nrs = set()
+	for tag, _, _, begin, end in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk = False).get_opcodes():
+		if tag in ('replace', 'insert'):
+			line_nrs.update(range(begin, end))
+		elif tag == 'delete':
+			line_nrs.update([begin - 1, begin])
+	return sorted(line_nrs)
+
+
+def watched_files(paths):
+	''' The given files, and the files in the given directories (recursively), skipping hidden ones '''
+	import os
+
+	for path in paths:
+		if not os.path.isdir(path):
+			yield path
+			continue
+		for dir_path, dir_names, file_names in os.walk(path):
+			dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+			for file_name in sorted(file_names):
+				if not file_name.startswith('.'):
+					yield os.path.join(dir_path, file_name)
+
+
+def poll_files(paths, state, options = None, cache = None, debounce = 0.3):
+	'''
+	One round of watch: realigns the blocks with the lines that changed in the watched files since the last round.
+	A file is only realigned once it has been left alone for debounce seconds, so that it isn't caught mid-save.
+	state is {file_name: (stat, text, time the stat was first seen)}, and is kept between rounds.
+	Files seen for the first time are only remembered.
+	Returns the names of the files that were realigned.
+	'''
+	import io
+	import os
+
+	realigned = []
+	now = time.time()
+	for file_name in watched_files(paths):
+		try:
+			stat = os.stat(file_name)
+		except OSError:
+			state.pop(file_name, None) # Deleted
+			continue
+		stat = (stat.st_mtime, stat.st_size)
+
+		old = state.get(file_name)
+		if old is not None and old[0] == stat:
+			if old[2] is None or now - old[2] < debounce:
+				continue # Unchanged, or not settled yet
+		elif old is not None:
+			state[file_name] = (stat, old[1], now) # Changed: wait for it to settle
+			if debounce > 0:
+				continue
+
+		try:
+			with io.open(file_name, newline='') as f:
+				text = f.read()
+		except (IOError, UnicodeDecodeError):
+			state.pop(file_name, None) # Not text
+			continue
+
+		if old is not None:
+			line_nrs = changed_line_nrs(old[1].split('\n'), text.split('\n'))
+			if line_nrs:
+				align_touched_files({file_name: line_nrs}, options, cache)
+				with io.open(file_name, newline='') as f:
+					aligned = f.read()
+				if aligned != text:
+					realigned.append(file_name)
+					text = aligned
+					stat = os.stat(file_name)
+					stat = (stat.st_mtime, stat.st_size)
+
+		state[file_name] = (stat, text, None)
+	return realigned
+
+
+def watch(paths, options = None, cache = None, interval = 0.5, debounce = 0.3):
+	''' Keeps the given files (and files in the given directories) aligned as they are saved, until interrupted '''
+	import sys
+
+	state = {}
+	while True:
+		for file_name in poll_files(paths, state, options, cache, debounce):
+			sys.stderr.write("{}: realigned\n".format(file_name))
+		time.sleep(interval)
 
 
 def main():
-	''' CLI. TODO: parse some flags? '''
+	''' CLI '''
+	import argparse
 	import fileinput  # reads from stdin or from file given as argument
 	import sys
 
+	parser = argparse.ArgumentParser(description='Aligns code. Reads from stdin if no files are given.')
+	parser.add_argument('files', nargs='*', help='files to align (or check)')
+	parser.add_argument('--check', action='store_true',
+		help="don't output anything, just report file:line of unaligned blocks and exit with 1 if there are any")
+	parser.add_argument('--diff', metavar='PATCH',
+		help="only align the blocks touched by this unified diff ('-' for stdin), in place in the files it names")
+	parser.add_argument('--print-diff', action='store_true',
+		help="don't change or output the text, print a unified diff of what would change instead")
+	parser.add_argument('--watch', action='store_true',
+		help="keep the given files, and files in the given directories, aligned as they are saved. Only the blocks with changed lines are realigned")
+	parser.add_argument('--max-memory', metavar='SIZE', type=parse_size,
+		help="memory budget per block, e.g. 500M. Blocks that would need more are aligned without phantom tokens, or left as they are")
+	parser.add_argument('--memory-report', action='store_true',
+		help="print peak memory use per phase to stderr")
+	parser.add_argument('--max-seconds', metavar='SECONDS', type=float,
+		help="time budget per block. Blocks that need longer are aligned without phantom tokens")
+	parser.add_argument('--segment', action='store_true',
+		help="align lines separately where consecutive lines have nothing in common to align, even if they are indented the same")
+	parser.add_argument('--table', metavar='DELIMITER',
+		help="align delimiter-separated rows, like CSV (,), TSV (tab) or Markdown tables (|), cell by cell instead of as code")
+	parser.add_argument('--validate', choices=['full', 'sampled', 'none'], default=g_validation,
+		help="how much to check internal invariants while aligning (default: %(default)s)")
+	parser.add_argument('--jobs', metavar='N', type=int, default=1,
+		help="processes to align big blocks with, when printing the aligned text. The output is the same for any number")
+	args = parser.parse_args()
+	if args.jobs > 1 and (args.check or args.diff or args.print_diff or args.watch or args.table):
+		parser.error("--jobs can't be combined with --check, --diff, --print-diff, --watch or --table")
+	if args.table and (args.check or args.diff or args.print_diff or args.watch):
+		parser.error("--table can't be combined with --check, --diff, --print-diff or --watch")
+	set_validation(args.validate)
+	options = default_options(max_memory = args.max_memory, max_seconds = args.max_seconds, segment = args.segment)
+	cache   = BlockCache() # Shared by all files, which often repeat the same blocks
+
+	if args.memory_report:
+		if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+			parser.error("--memory-report needs Python 3.9 or later")
+		tracemalloc.start()
+
+	if args.diff:
+		touched = parse_unified_diff(read_lines(args.diff))
+		if args.files:
+			touched = dict((file_name, touched.get(file_name, [])) for file_name in args.files)
+		if args.check:
+			if not check_files(sorted(touched), touched, options, cache):
+				sys.exit(1)
+		elif args.print_diff:
+			print_diffs(sorted(touched), touched, options, cache)
+		else:
+			align_touched_files(touched, options, cache)
+		return
+
+	if args.check:
+		if not check_files(args.files or ['-'], None, options, cache):
+			sys.exit(1)
+		return
+
+	if args.print_diff:
+		print_diffs(args.files or ['-'], None, options, cache)
+		return
+
+	if args.table:
+		delimiter = '\t' if args.table in ('tab', '\\t') else args.table
+		if len(delimiter) != 1:
+			parser.error("--table needs a single character delimiter, or 'tab'")
+		for file_name in args.files or ['-']:
+			# Files are read twice rather than kept in memory:
+			lines = read_lines(file_name) if file_name == '-' else FileLines(file_name)
+			for line in align_table(lines, delimiter):
+				sys.stdout.write(line + '\n')
+		return
+
+	if args.watch:
+		if not args.files:
+			parser.error("--watch needs files or directories to watch")
+		try:
+			watch(args.files, options, cache)
+		except KeyboardInterrupt:
+			pass
+		return
+
 	lines = []
-	for line in fileinput.input():
+	for line in fileinput.input(files=args.files):
 		lines.append(line)
 
 	if len(lines) == 0:
 		print_help()
 	else:
-		aligned = alignify_lines(lines)
+		pool = None
+		if args.jobs > 1:
+			import multiprocessing
+			pool = multiprocessing.Pool(args.jobs)
+
+		report = Report()
+		try:
+			aligned = alignify_lines(lines, options, report, cache, pool)
+		finally:
+			if pool is not None:
+				pool.terminate()
 		sys.stdout.write(aligned)  # no trailing newline
+		print_report(report)
 
 
 if __name__ == '__main__':
@@ -867,16 +2755,69 @@ def module_exists(module_name):
 
 if module_exists('sublime_plugin'):
 	# ST3 plugin
+	import sublime
 	import sublime_plugin
 
+	g_block_cache = BlockCache() # Kept for as long as Sublime Text runs
+
 	class AlignifyCommand(sublime_plugin.TextCommand):
+		'''
+		Aligns the selected lines on a background thread, so that large
+		selections don't freeze the editor. The changed lines are replaced in a single
+		edit by AlignifyReplaceCommand, unless the buffer changed meanwhile.
+		'''
 
 		def run(self, edit):
-			for region in self.view.sel():
+			view    = self.view
+			regions = []
+			for region in view.sel():
 				if not region.empty():
 					# Extend selection to full lines:
-					region = self.view.line(region)
-					original = self.view.substr(region)
-					aligned = alignify_string(original)
-					if aligned != original:
-						self.view.replace(edit, region, aligned)
+					region = view.line(region)
+					if regions and region.begin() <= regions[-1][1]:
+						# Shares a line with the previous selection: align them together
+						regions[-1][1] = max(regions[-1][1], region.end())
+					else:
+						regions.append([region.begin(), region.end()])
+
+			if not regions:
+				return
+
+			texts = [view.substr(sublime.Region(begin, end)) for begin, end in regions]
+			change_count = view.change_count()
+
+			def align():
+				options = default_options()
+				edits = {} # Shared by all regions: identical selections are aligned once
+				replacements = []
+				for (begin, end), original in zip(regions, texts):
+					if original not in edits:
+						# Only the lines that change are replaced:
+						lines = original.split('\n')
+						line_begins = [0]
+						for line in lines:
+							line_begins.append(line_begins[-1] + len(line) + 1)
+						edits[original] = [(line_begins[line_nr], line_begins[line_nr] + len(old_line), new_line)
+						                   for line_nr, old_line, new_line in line_edits(lines, options = options, cache = g_block_cache)]
+					for edit_begin, edit_end, new_line in edits[original]:
+						replacements.append([[begin + edit_begin, begin + edit_end], new_line])
+
+				if replacements:
+					view.run_command('alignify_replace', {
+						'replacements': replacements,
+						'change_count': change_count,
+					})
+
+			sublime.set_timeout_async(align, 0)
+
+	class AlignifyReplaceCommand(sublime_plugin.TextCommand):
+		''' Applies the result of AlignifyCommand in one undoable edit. '''
+
+		def run(self, edit, replacements, change_count):
+			if self.view.change_count() != change_count:
+				sublime.status_message('Alignify: buffer changed while aligning, nothing applied')
+				return
+
+			# Back to front, so that earlier regions keep their offsets:
+			for (begin, end), aligned in sorted(replacements, reverse = True):
+				self.view.replace(edit, sublime.Region(begin, end), aligned)
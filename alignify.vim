@@ -0,0 +1,28 @@
+" Aligns code from within Vim: https://github.com/emilk/alignify
+" Put this file next to alignify.py in ~/.vim/plugin/ and align a range with :Alignify
+" Needs a Vim with +python3. alignify.py is imported once, and only the lines
+" that need aligning are written back to the buffer.
+
+if exists('g:loaded_alignify') || !has('python3')
+	finish
+endif
+let g:loaded_alignify = 1
+
+let s:plugin_dir = expand('<sfile>:p:h')
+
+python3 << EOF
+import sys
+import vim
+
+sys.path.insert(0, vim.eval('s:plugin_dir'))
+import alignify
+
+alignify_vim_cache = alignify.BlockCache() # Kept for the whole Vim session
+
+def alignify_vim_range(first, last):
+	buffer = vim.current.buffer
+	for line_nr, line in alignify.changed_lines(buffer[first - 1:last], cache = alignify_vim_cache):
+		buffer[first - 1 + line_nr] = line
+EOF
+
+command! -range=% Alignify python3 alignify_vim_range(<line1>, <line2>)
@@ -432,7 +432,685 @@ TESTS = [
 	),
 ]
 
+def check_already_aligned():
+	''' Returns the number of failures '''
+	failures = 0
+	cases = [
+		(["int   one = 1; // Duh", "float pi  = 3; // Close enough."],        True),
+		(["red   = { 255,   0, 0 }", "green = {   0, 255, 0 }"],              True),
+		(["int one = 1;", "float pi = 3;"],                                    False),
+		(["a  b"],                                                              False),
+	]
+	for meat_lines, expected in cases:
+		ast_lines = [alignify.parse(meat)[0] for meat in meat_lines]
+		comments = alignify.strip_comments(ast_lines)
+		actual = alignify.is_aligned_block(meat_lines, ast_lines, comments)
+		if actual != expected:
+			print("\nFAILURE!\nis_aligned_block({}) returned {}\n".format(meat_lines, actual))
+			failures += 1
+	return failures
+
+
+def check_find_unaligned_line():
+	''' Returns the number of failures '''
+	failures = 0
+	cases = [
+		(["a   b", "ccc d", "\tx y"], None),
+		(["a   b", "ccc d", "\tx  y"], 2),
+		(["a b", "ccc d", "\tx  y"], 0),
+	]
+	for lines, expected in cases:
+		actual = alignify.find_unaligned_line(lines)
+		if actual != expected:
+			print("\nFAILURE!\nfind_unaligned_line({}) returned {}, expected {}\n".format(lines, actual, expected))
+			failures += 1
+
+	lines = ["a b", "ccc d", "\tx y", "\tzz w"]
+	expected = [(0, "a   b"), (2, "\tx  y")]
+	actual = alignify.changed_lines(lines)
+	if actual != expected:
+		print("\nFAILURE!\nchanged_lines({}) returned {}, expected {}\n".format(lines, actual, expected))
+		failures += 1
+	return failures
+
+
+def check_unified_diff():
+	''' Returns the number of failures '''
+	failures = 0
+	lines = ["a = 1", "bbb = 2", "", "", "", "", "", "", "", "\tx = 1", "\tyy = 2"]
+	expected = [
+		"--- f.c",
+		"+++ f.c",
+		"@@ -1,2 +1,2 @@",
+		"-a = 1",
+		"+a   = 1",
+		" bbb = 2",
+		"@@ -9,3 +9,3 @@",
+		" ",
+		"-\tx = 1",
+		"+\tx  = 1",
+		" \tyy = 2",
+	]
+	actual = list(alignify.unified_diff(lines, "f.c", context = 1))
+	if actual != expected:
+		print("\nFAILURE!\nunified_diff:\nExpected:\n{}\nGot:\n{}\n".format("\n".join(expected), "\n".join(actual)))
+		failures += 1
+
+	actual = list(alignify.line_edits(lines))
+	if actual != [(0, "a = 1", "a   = 1"), (9, "\tx = 1", "\tx  = 1")]:
+		print("\nFAILURE!\nline_edits returned {}\n".format(actual))
+		failures += 1
+	return failures
+
+
+def check_touched_lines():
+	''' Returns the number of failures '''
+	failures = 0
+
+	diff = [
+		"--- a/f.c",
+		"+++ b/f.c",
+		"@@ -1,4 +1,5 @@",
+		" x = 1",
+		" foo = 2",
+		" \tint a = 1;",
+		"-\tfloat b = 2;",
+		"+\tfloat bb = 2;",
+		"+\tchar c;",
+	]
+	touched = alignify.parse_unified_diff(diff)
+	if sorted(touched) != ["f.c"] or sorted(set(touched["f.c"])) != [3, 4]:
+		print("\nFAILURE!\nparse_unified_diff returned {}\n".format(touched))
+		failures += 1
+
+	# Replacing the first line of a block doesn't touch the block above it, but removing lines touches both sides:
+	cases = [
+		(["@@ -1,4 +1,4 @@", " \tfoo = 1", " \tbarbaz = 2", "-zz = 1", "+zzz = 1", " y = 2"], [2]),
+		(["@@ -1,4 +1,3 @@", " \tfoo = 1", " \tbarbaz = 2", "-zz = 1", " y = 2"],              [1, 2]),
+		(["@@ -2,2 +2,1 @@", " \tbarbaz = 2", "-zz = 1"],                                      [1, 2]),
+	]
+	for hunk, expected in cases:
+		touched = alignify.parse_unified_diff(["--- a/g.c", "+++ b/g.c"] + hunk)
+		if sorted(set(touched["g.c"])) != expected:
+			print("\nFAILURE!\nparse_unified_diff of {} returned {}, expected {}\n".format(hunk, touched, expected))
+			failures += 1
+
+	lines = ["\tfoo = 1", "\tbarbaz = 2", "zzz = 1", "y = 2"]
+	touched = alignify.parse_unified_diff(["--- a/g.c", "+++ b/g.c"] + cases[0][0])
+	actual = alignify.alignify_touched_lines(lines, touched["g.c"])
+	if actual != ["\tfoo = 1", "\tbarbaz = 2", "zzz = 1", "y   = 2"]:
+		print("\nFAILURE!\nalignify_touched_lines after replacing the first line of a block returned {}\n".format(actual))
+		failures += 1
+
+	lines = ["x = 1", "foo = 2", "\tint a = 1;", "\tfloat bb = 2;", "\tchar c;"]
+	expected = ["x = 1", "foo = 2", "\tint   a  = 1;", "\tfloat bb = 2;", "\tchar  c;"]
+	actual = alignify.alignify_touched_lines(lines, [3, 4])
+	if actual != expected:
+		print("\nFAILURE!\nalignify_touched_lines returned {}\n".format(actual))
+		failures += 1
+
+	return failures
+
+
+def check_deep_nesting():
+	''' Returns the number of failures '''
+	depth = 1500 # Deeper than the default recursion limit
+	before   = "a = "  + "{ " * depth + "1, 22" + " }" * depth + "\n" + "bb = " + "{ " * depth + "333, 4" + " }" * depth
+	expected = "a  = " + "{ " * depth + "  1, 22" + " }" * depth + "\n" + "bb = " + "{ " * depth + "333,  4" + " }" * depth
+	# The full validation rechecks each group at every level it is in, which takes quadratic time:
+	alignify.set_validation('none')
+	try:
+		actual = alignify.alignify_string(before)
+	finally:
+		alignify.set_validation('full')
+	if actual != expected:
+		print("\nFAILURE!\nDeeply nested input not aligned as expected\n")
+		return 1
+	return 0
+
+
+def check_options():
+	''' Returns the number of failures '''
+	failures = 0
+	before = "\ta b\n\n\tccc d"
+	cases = [
+		(alignify.default_options(ignore_empty_lines = True),  "\ta   b\n\n\tccc d"),
+		(alignify.default_options(ignore_empty_lines = False), "\ta b\n\n\tccc d"),
+	]
+	for options, expected in cases:
+		actual = alignify.alignify_string(before, options)
+		if actual != expected:
+			print("\nFAILURE!\nWith {}:\nExpected:\n{}\nGot:\n{}\n".format(options, expected, actual))
+			failures += 1
+	return failures
+
+
+def check_similarity_upper_bound():
+	''' Returns the number of failures '''
+	failures = 0
+	tokens = ['', ' ', '=', '+', 'x', 'x,', 'int', 'Map<String,', 'height_in_items)', '"grass"', '1_000', '-3e-12', '{']
+	for a in tokens:
+		for b in tokens:
+			bound = alignify.similarity_upper_bound(a, b)
+			actual = alignify.token_similarity(a, b)
+			if bound < actual:
+				print("\nFAILURE!\nsimilarity_upper_bound('{}', '{}') = {} < {}\n".format(a, b, bound, actual))
+				failures += 1
+	return failures
+
+
+def check_node_summaries():
+	''' Returns the number of failures '''
+	failures = 0
+	small = alignify.parse("{ a, b }")[0][0]
+	big   = alignify.parse('{ "n": { 3, 4 }, "name": "gradient", "width": 64, "height": 64, "symmetry": 2 }')[0][0]
+	summaries = alignify.NodeSummaries()
+
+	cases = [
+		(small, (alignify.collapse_node(small), 0, 0)),
+		# The opener and the first tokens of the first three children, "n":, { 3, 4 } and "name":
+		(big,   ('{ "n": { "name":', len(alignify.collapse_node(big)) - 16, 8)),
+	]
+	for node, expected in cases:
+		actual = summaries.summary(node)
+		if actual != expected:
+			print("\nFAILURE!\nSummary of '{}':\nExpected: {}\nGot:      {}\n".format(alignify.collapse_node(node), expected, actual))
+			failures += 1
+
+	nodes = [small, big, "x", '"a long string literal that is not summarized at all"']
+	for a in nodes:
+		for b in nodes:
+			summary_a = summaries.summary(a)
+			summary_b = summaries.summary(b)
+			bound  = alignify.summary_similarity_bound(summary_a, summary_b)
+			actual = alignify.summary_similarity(summary_a, summary_b)
+			if bound < actual:
+				print("\nFAILURE!\nsummary_similarity_bound of '{}' and '{}': {} < {}\n".format(a, b, bound, actual))
+				failures += 1
+	return failures
+
+
+def check_bounded_levenshtein():
+	''' Returns the number of failures '''
+	failures = 0
+	pairs = [("foo", "bar"), ("height_in_items", "label,"), ("height_in_items", "std::string&"), ("A!", "a"), ("same", "same")]
+	for a, b in pairs:
+		exact = alignify.levenshtein_distance(a, b)
+		for max_distance in range(0, exact + 5):
+			bounded = alignify.levenshtein_distance(a, b, max_distance)
+			if (exact <= max_distance and bounded != exact) or (exact > max_distance and bounded <= max_distance):
+				print("\nFAILURE!\nlevenshtein_distance('{}', '{}', {}) = {}, exact: {}\n".format(a, b, max_distance, bounded, exact))
+				failures += 1
+	return failures
+
+
+def check_approximate_distance():
+	''' Returns the number of failures '''
+	failures = 0
+	cases = [
+		('"some string"',       '"some string"',             0),
+		('"hello world"',       '"hello there world"',       15), # Adds 'there' (5 letters) and a space (10)
+		('"error: bad file"',   '"error: bad input file"',   None),
+		('"one two three"',     'x',                         None),
+	]
+	for a, b, expected in cases:
+		actual = alignify.approximate_distance(a, b)
+		if expected is not None and actual != expected:
+			print("\nFAILURE!\napproximate_distance('{}', '{}') = {}, expected: {}\n".format(a, b, actual, expected))
+			failures += 1
+		if actual < abs(len(a) - len(b)):
+			print("\nFAILURE!\napproximate_distance('{}', '{}') = {}, less than the difference in length\n".format(a, b, actual))
+			failures += 1
+	return failures
+
+
+def check_token_annotations():
+	''' Returns the number of failures '''
+	failures = 0
+	nodes, _ = alignify.parse("Foo_b = -1.5; // comment")
+	expected = [
+		# token,        kind,       classes,      decimal
+		("Foo_b",       "word",     "Aaaaa",      None),
+		(" ",           "space",    ".",          None),
+		("=",           "operator", ".",          None),
+		(" ",           "space",    ".",          None),
+		("-1.5;",       "word",     ".....",      2),
+		(" ",           "space",    ".",          None),
+		("// comment",  "comment",  "...aaaaaaa", None),
+	]
+	actual = [(str(node), node.kind, node.classes, node.decimal) for node in nodes]
+	if actual != expected:
+		print("\nFAILURE!\nToken annotations:\nExpected:\n{}\nGot:\n{}\n".format(expected, actual))
+		failures += 1
+
+	again, _ = alignify.parse("Foo_b = -1.5; // comment")
+	if any(a is not b for a, b in zip(nodes, again)):
+		print("\nFAILURE!\nEqual tokens should share one Token\n")
+		failures += 1
+	return failures
+
+
+def check_memory_budget():
+	''' Returns the number of failures '''
+	failures = 0
+	before = "int x;\nmap<a, b> y;\nmap<int, string> z;"
+	ast_lines = [alignify.parse(line)[0] for line in before.split('\n')]
+	cheap = alignify.estimate_block_memory(ast_lines, False)
+	cases = [
+		(None,      "int              x;\nmap<a,   b>      y;\nmap<int, string> z;", 0),
+		(cheap,     "int      x;\nmap<a,   b>      y;\nmap<int, string> z;",         1), # No phantom tokens
+		(cheap - 1, before,                                                           1), # Unaligned
+	]
+	for max_memory, expected, num_degraded in cases:
+		report = alignify.Report()
+		actual = alignify.alignify_string(before, alignify.default_options(max_memory = max_memory), report)
+		if actual != expected or len(report.degraded) != num_degraded:
+			print("\nFAILURE!\nWith max_memory = {}:\nExpected:\n{}\nGot:\n{}\nDegraded: {}\n".format(
+				max_memory, expected, actual, report.degraded))
+			failures += 1
+	return failures
+
+
+def check_memory_estimate():
+	''' Returns the number of failures '''
+	tracemalloc = alignify.tracemalloc
+	if tracemalloc is None or tracemalloc.is_tracing():
+		return 0 # Can't measure
+
+	lines = ['entry{} = make_entry("name{}", {}.5, -{}); // row {}'.format(i, i * 7, i * 3, i % 11, i) for i in range(150)]
+	lines[::3] = ["e{} = f({});".format(i, i) for i in range(50)]
+	alignify.alignify_string("\n".join(lines)) # So the one-off allocations (like interned tokens) aren't measured
+
+	failures = 0
+	for phantom_tokens in [False, True]:
+		ast_lines = [alignify.parse(line)[0] for line in lines]
+		estimate = alignify.estimate_block_memory(ast_lines, phantom_tokens)
+		tracemalloc.start()
+		try:
+			before = tracemalloc.get_traced_memory()[0]
+			alignify.align_and_collect([''] * len(lines), ast_lines, lines, alignify.default_options(phantom_tokens = phantom_tokens))
+			measured = tracemalloc.get_traced_memory()[1] - before
+		finally:
+			tracemalloc.stop()
+		if not measured / 2 <= estimate <= measured * 4:
+			print("\nFAILURE!\nWith phantom_tokens = {}, estimated {} bytes, but {} were used\n".format(phantom_tokens, estimate, measured))
+			failures += 1
+	return failures
+
+
+def check_time_budget():
+	''' Returns the number of failures '''
+	failures = 0
+	before = "int x;\nmap<a, b> y;\nmap<int, string> z;"
+	cases = [
+		(None, "int              x;\nmap<a,   b>      y;\nmap<int, string> z;", 0),
+		(60,   "int              x;\nmap<a,   b>      y;\nmap<int, string> z;", 0),
+		(0,    "int      x;\nmap<a,   b>      y;\nmap<int, string> z;",         1), # No phantom tokens
+	]
+	for max_seconds, expected, num_degraded in cases:
+		report = alignify.Report()
+		actual = alignify.alignify_string(before, alignify.default_options(max_seconds = max_seconds), report)
+		if actual != expected or len(report.degraded) != num_degraded:
+			print("\nFAILURE!\nWith max_seconds = {}:\nExpected:\n{}\nGot:\n{}\nDegraded: {}\n".format(
+				max_seconds, expected, actual, report.degraded))
+			failures += 1
+	return failures
+
+
+def check_block_cache():
+	''' Returns the number of failures '''
+	failures = 0
+	before   = "{\n\ta = 1\n\tbbb = 2\n}\n{\n\ta = 1\n\tbbb = 2\n}\n{\n\tccc = 3\n\td = 4\n}"
+	expected = alignify.alignify_string(before)
+
+	cache = alignify.BlockCache(max_blocks = 2)
+	actual = alignify.alignify_string(before, cache = cache)
+	if actual != expected:
+		print("\nFAILURE!\nWith a cache:\nExpected:\n{}\nGot:\n{}\n".format(expected, actual))
+		failures += 1
+
+	# The blocks are {, a-bbb, }{, a-bbb, }{, ccc-d and }, of which the 2nd a-bbb and }{ are hits
+	if (cache.hits, cache.misses, len(cache)) != (2, 5, 2):
+		print("\nFAILURE!\nBlockCache hits/misses/size: {} {} {}\n".format(cache.hits, cache.misses, len(cache)))
+		failures += 1
+	return failures
+
+
+def check_sharded():
+	''' Returns the number of failures '''
+	import multiprocessing
+
+	failures = 0
+	lines = [
+		"int x = 1;",
+		"map<int, string> names = {};",
+		"float y;",
+		"std::vector<int> values = { 1, 2, 3 };",
+		"int z = { 4, 5 };",
+	]
+	expected = alignify.alignify_lines(lines)
+
+	shard_lines = alignify.SHARD_LINES
+	alignify.SHARD_LINES = 2
+	pool = multiprocessing.Pool(2)
+	try:
+		actual = alignify.alignify_lines(lines, pool = pool)
+	finally:
+		pool.terminate()
+		alignify.SHARD_LINES = shard_lines
+
+	if actual != expected:
+		print("\nFAILURE!\nSharded:\nExpected:\n{}\nGot:\n{}\n".format(expected, actual))
+		failures += 1
+	return failures
+
+
+def check_alignify_many():
+	''' Returns the number of failures '''
+	failures = 0
+	strings = [
+		"int x = 1;\nfloat yy = 2;",
+		None, # Not a string: fails on its own
+		"a = [1, 2]\nbbb = [3, 4, 5]",
+		"int x = 1;\nfloat yy = 2;",
+	]
+
+	import multiprocessing
+	pool = multiprocessing.Pool(2)
+	try:
+		# The same pool twice, so its processes keep their caches between the calls:
+		for how, kwargs in [("1 job", {}), ("2 jobs", {"jobs": 2}), ("a pool", {"pool": pool}), ("the pool again", {"pool": pool})]:
+			results = alignify.alignify_many(strings, batch_size = 2, **kwargs)
+			if len(results) != len(strings) or not isinstance(results[1], Exception):
+				print("\nFAILURE!\nalignify_many with {}: {}\n".format(how, results))
+				failures += 1
+				continue
+
+			for s, actual in zip(strings, results):
+				if s is not None and actual != alignify.alignify_string(s):
+					print("\nFAILURE!\nalignify_many with {}:\nExpected:\n{}\nGot:\n{}\n".format(how, alignify.alignify_string(s), actual))
+					failures += 1
+
+		try:
+			alignify.alignify_many(strings, cache = alignify.BlockCache(), pool = pool)
+			print("\nFAILURE!\nalignify_many took a cache it can't use with a pool\n")
+			failures += 1
+		except ValueError:
+			pass
+	finally:
+		pool.terminate()
+	return failures
+
+
+def check_alignment_plan():
+	''' Returns the number of failures '''
+	failures = 0
+	rows = ["int x = 1; // one", "float yy = 22.5;", "double zzz = 3.25; // three", "y = 4;"]
+	plan = alignify.AlignmentPlan(rows)
+
+	expected = alignify.alignify_lines(rows).split('\n')
+	actual   = plan.apply(rows)
+	if actual != expected:
+		print("\nFAILURE!\nAlignmentPlan.apply:\nExpected:\n{}\nGot:\n{}\n".format("\n".join(expected), "\n".join(actual)))
+		failures += 1
+
+	cases = [
+		(["int w = 2.5;"],   False, ["int    w   =  2.5;"]),
+		(["a = 123.75;"],    True,  ["a          = 123.75;"]),
+		(["int v = 1; // c"], False, ["int    v   =   1;    // c"]),
+	]
+	for more_rows, expect_widened, expected in cases:
+		widened = plan.extend(more_rows)
+		actual  = plan.apply(more_rows)
+		if widened != expect_widened or actual != expected:
+			print("\nFAILURE!\nAlignmentPlan.extend({}) returned {}, then apply gave {}\n".format(more_rows, widened, actual))
+			failures += 1
+
+	# Rows with as many nodes as each other but placed differently, and numbers in columns that had none:
+	cases = [
+		(["map<a, b> y = 1;", "int x;", "z = 5;", "= 5;"], None),
+		(["name value"],                                  ["x 1"]),
+	]
+	for rows, more_rows in cases:
+		plan = alignify.AlignmentPlan(rows)
+		try:
+			if more_rows is None:
+				expected = alignify.alignify_lines(rows).split('\n')
+				actual   = plan.apply(rows)
+			else:
+				expected = ["x    1"] # Pushed right, not crashing
+				actual   = plan.apply(more_rows)
+		except Exception as e:
+			actual = e
+		if actual != expected:
+			print("\nFAILURE!\nAlignmentPlan({}).apply:\nExpected: {}\nGot:      {}\n".format(rows, expected, actual))
+			failures += 1
+
+	# Extending with a new longest row places everything as if the plan had been made from all the rows:
+	rows, more_rows = ["Foo", "22.5; -3", "foo float", "-3"], ["x; foo", "22.5; 1; Foo yy ="]
+	plan = alignify.AlignmentPlan(rows)
+	plan.extend(more_rows)
+	expected = alignify.AlignmentPlan(rows + more_rows).apply(rows + more_rows)
+	actual   = plan.apply(rows + more_rows)
+	if actual != expected:
+		print("\nFAILURE!\nAlignmentPlan extended with a new longest row:\nExpected: {}\nGot:      {}\n".format(expected, actual))
+		failures += 1
+
+	# Rows with the same signature are only matched to the columns once:
+	plan = alignify.AlignmentPlan(["time=12 level=info user=bob msg=started"])
+	expand_short_line = alignify.expand_short_line
+	calls = []
+	alignify.expand_short_line = lambda *args: calls.append(args) or expand_short_line(*args)
+	try:
+		plan.apply(["time=10 msg=ok", "time=11 msg=no", "time=99 msg=hi"])
+	finally:
+		alignify.expand_short_line = expand_short_line
+	if len(calls) != 1:
+		print("\nFAILURE!\nAlignmentPlan.apply searched for phantom tokens {} times, expected once\n".format(len(calls)))
+		failures += 1
+	return failures
+
+
+def check_watch():
+	''' Returns the number of failures '''
+	import os
+	import shutil
+	import tempfile
+
+	failures = 0
+	cases = [
+		(["a", "b", "c"], ["a", "b", "c"],      []),
+		(["a", "b", "c"], ["a", "B", "c"],      [1]),
+		(["a", "b", "c"], ["a", "b", "x", "c"], [2]),
+		(["a", "b", "c"], ["a", "c"],           [0, 1]),
+		(["a", "b", "c", "d", "e"], ["A", "b", "c", "d", "E"], [0, 4]), # Not the lines between the edits
+	]
+	for old_lines, new_lines, expected in cases:
+		actual = alignify.changed_line_nrs(old_lines, new_lines)
+		if actual != expected:
+			print("\nFAILURE!\nchanged_line_nrs({}, {}) returned {}, expected {}\n".format(old_lines, new_lines, actual, expected))
+			failures += 1
+
+	directory = tempfile.mkdtemp()
+	try:
+		file_name = os.path.join(directory, "table.txt")
+		with open(file_name, "w") as f:
+			f.write("a = 1\nbbb = 2\n\tx = 1\n\tyy = 2\n")
+
+		state = {}
+		first  = alignify.poll_files([directory], state, debounce = 0) # Only remembers the file
+		with open(file_name, "w") as f:
+			f.write("a = 1\nbbb = 2\n\tx = 1\n\tyy = 2\n\tz = 3\n")
+		second = alignify.poll_files([directory], state, debounce = 0)
+		with open(file_name) as f:
+			text = f.read()
+
+		expected = "a = 1\nbbb = 2\n\tx  = 1\n\tyy = 2\n\tz  = 3\n" # The untouched block is left as it was
+		if first != [] or second != [file_name] or text != expected:
+			print("\nFAILURE!\npoll_files returned {} then {}, and left:\n{}\n".format(first, second, text))
+			failures += 1
+	finally:
+		shutil.rmtree(directory)
+	return failures
+
+
+def check_segment():
+	''' Returns the number of failures '''
+	failures = 0
+	before = "int x = 1;\nfloat yy = 2;\nfoo(bar);\ndo_thing(a, b);\nreturn_value_of_something(c, d);"
+	cases = [
+		(False, "int                          x  = 1;\nfloat                        yy = 2;\nfoo(bar);\ndo_thing(a,                  b);\nreturn_value_of_something(c, d);"),
+		(True,  "int   x  = 1;\nfloat yy = 2;\nfoo(bar);\ndo_thing(a,                  b);\nreturn_value_of_something(c, d);"),
+	]
+	for segment, expected in cases:
+		actual = alignify.alignify_string(before, alignify.default_options(segment = segment))
+		if actual != expected:
+			print("\nFAILURE!\nWith segment = {}:\nExpected:\n{}\nGot:\n{}\n".format(segment, expected, actual))
+			failures += 1
+	return failures
+
+
+def check_table():
+	''' Returns the number of failures '''
+	failures = 0
+	cases = [
+		(",", [
+			"name,qty,price",
+			"apple, 3, 1.5",
+			"\"banana, split\",12,10.25",
+		], [
+			"name,            qty, price",
+			"apple,            3,   1.5",
+			"\"banana, split\", 12,  10.25",
+		]),
+		("|", [
+			"| Name | Qty |",
+			"|---|--:|",
+			"| apple | 3 |",
+			"| banana split | 12.5 |",
+		], [
+			"| Name         | Qty  |",
+			"| ------------ | ---: |",
+			"| apple        |  3   |",
+			"| banana split | 12.5 |",
+		]),
+		("|", [
+			"| a | b |",
+			"|---|---|",
+			"| x | y |",
+		], [
+			"| a   | b   |",
+			"| --- | --- |",
+			"| x   | y   |",
+		]),
+		(",", [
+			"name,qty",
+			"apple,",
+			"kiwi,4",
+		], [
+			"name,  qty",
+			"apple,",
+			"kiwi,  4",
+		]),
+		("|", [
+			"Name | Qty",
+			"---|---",
+			"banana split | 12.5",
+		], [
+			"Name         | Qty",
+			"------------ | ----",
+			"banana split | 12.5",
+		]),
+		("\t", [
+			"name\tqty\tnote",
+			"apple\t3\tfresh",
+			"banana split\t12.5\t",
+		], [
+			"name        \tqty \tnote",
+			"apple       \t 3  \tfresh",
+			"banana split\t12.5\t",
+		]),
+	]
+	for delimiter, before, expected in cases:
+		actual = list(alignify.align_table(before, delimiter))
+		if actual != expected or list(alignify.align_table(actual, delimiter)) != expected:
+			print("\nFAILURE!\nalign_table:\nExpected:\n{}\nGot:\n{}\n".format("\n".join(expected), "\n".join(actual)))
+			failures += 1
+	return failures
+
+
+def check_document():
+	''' Returns the number of failures '''
+	failures = 0
+	lines = ["a = 1", "bbb = 2", "\tx = 1", "\tyy = 2", "c = 3", "dd = 4"]
+	expected = alignify.alignify_lines(lines).split('\n')
+
+	document = alignify.Document(lines)
+	document.show(2, 4)
+	visible = document.get_lines(2, 4)
+	aligned_first = document.is_aligned()
+	num_steps = 0
+	while document.align_next():
+		num_steps += 1
+
+	if visible != expected[2:4] or aligned_first or num_steps != 2 or document.get_lines() != expected:
+		print("\nFAILURE!\nDocument gave {} for the visible lines, then {} in {} steps\n".format(visible, document.get_lines(), num_steps))
+		failures += 1
+	return failures
+
+
+def check_sparse_columns():
+	''' Returns the number of failures '''
+	failures = 0
+	options = alignify.default_options(phantom_tokens = False)
+	lines = [alignify.parse(line)[0] for line in ["a b c d e f", "gg h"]]
+	expected = [{0: 'a', 1: ' ', 2: 'b', 3: ' ', 4: 'c', 5: ' ', 6: 'd', 7: ' ', 8: 'e', 9: ' ', 10: 'f'},
+	            {0: 'gg', 1: ' ', 2: 'h'}] # No padding for the short line
+	actual = alignify.expand_short_lines(lines, options)
+	if actual != expected:
+		print("\nFAILURE!\nexpand_short_lines returned {}, expected {}\n".format(actual, expected))
+		failures += 1
+
+	actual = alignify.align_columns(expected)
+	if actual != ["a  b c d e f", "gg h"]:
+		print("\nFAILURE!\nalign_columns returned {}\n".format(actual))
+		failures += 1
+	return failures
+
+
+def check_validation():
+	''' Returns the number of failures '''
+	failures = 0
+	bad_lines = [["a", 1]] # Not a list of nodes
+
+	for level, should_raise in [('none', False), ('full', True)]:
+		alignify.set_validation(level)
+		try:
+			alignify.assert_is_list_of_nodes(bad_lines[0])
+			raised = False
+		except AssertionError:
+			raised = True
+		if raised != should_raise:
+			print("\nFAILURE!\nWith validation '{}', a bad node {}\n".format(level, "raised" if raised else "passed"))
+			failures += 1
+
+	alignify.set_validation('sampled')
+	raised = 0
+	for _ in range(2 * alignify.VALIDATION_SAMPLE_EVERY):
+		try:
+			alignify.assert_is_list_of_nodes(bad_lines[0])
+		except AssertionError:
+			raised += 1
+	if raised != 2:
+		print("\nFAILURE!\nWith sampled validation, {} of {} checks raised\n".format(raised, 2 * alignify.VALIDATION_SAMPLE_EVERY))
+		failures += 1
+
+	alignify.set_validation('full')
+	return failures
+
+
 def main():
+	alignify.set_validation('full') # Check every invariant while testing
 	failures = 0
 
 	for before, expected in TESTS:
@@ -442,13 +1120,42 @@ def main():
 			print("\nFAILURE!\nInput:\n{}\nExpected:\n{}\nGot:\n{}\n\n".format(before, expected, actual))
 			failures += 1
 
-
 	if failures == 0:
 		print("All {} tests passed".format(len(TESTS)))
 	else:
 		print("{}/{} tests failed".format(failures, len(TESTS)))
 
-
+	checks = [
+		check_already_aligned,
+		check_find_unaligned_line,
+		check_touched_lines,
+		check_unified_diff,
+		check_deep_nesting,
+		check_options,
+		check_similarity_upper_bound,
+		check_node_summaries,
+		check_bounded_levenshtein,
+		check_approximate_distance,
+		check_token_annotations,
+		check_memory_budget,
+		check_memory_estimate,
+		check_sparse_columns,
+		check_time_budget,
+		check_block_cache,
+		check_alignify_many,
+		check_sharded,
+		check_alignment_plan,
+		check_watch,
+		check_segment,
+		check_table,
+		check_document,
+		check_validation,
+	]
+	failed_checks = [check.__name__ for check in checks if check() > 0]
+	if not failed_checks:
+		print("All {} checks passed".format(len(checks)))
+	else:
+		print("{}/{} checks failed: {}".format(len(failed_checks), len(checks), ", ".join(failed_checks)))
 
 
 if __name__ == '__main__':